@@ -0,0 +1,161 @@
+"""Approximate nearest-neighbor classifier for the high-dimensional CNN blocks.
+
+An inverted file (IVF) index: k-means splits the training rows into
+`n_lists` cells, and a query is only compared with the rows of its `n_probe`
+closest cells instead of the whole training fold. More probes find more of
+the true neighbors at the cost of speed, n_probe = n_lists is exact search.
+Queries are processed cell by cell, so every distance computation is one
+matrix product between the queries probing a cell and the rows of that cell.
+"""
+import time
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.utils.validation import check_is_fitted
+
+def squared_distances(A, B, B_norms=None):
+    """Squared euclidean distances between the rows of A and B."""
+    B_norms = np.einsum('ij,ij->i', B, B) if B_norms is None else B_norms
+    distances = np.einsum('ij,ij->i', A, A)[:, None] - 2 * A @ B.T + B_norms[None, :]
+    return np.maximum(distances, 0, out=distances)
+
+def kmeans(X, n_clusters, n_iter=10, sample_size=None, random_state=0):
+    """Lloyd's k-means on a random sample of the rows, returns the centroids."""
+    rng = np.random.default_rng(random_state)
+    sample_size = sample_size or max(n_clusters * 40, 10000)
+    if len(X) > sample_size:
+        X = X[np.sort(rng.choice(len(X), sample_size, replace=False))]
+    centroids = X[rng.choice(len(X), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = np.argmin(squared_distances(X, centroids), axis=1)
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, X)
+        # Empty cells keep their centroid.
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+class IVFKNeighborsClassifier(BaseEstimator, ClassifierMixin):
+    """k-nearest neighbors vote over an IVF index of the training rows.
+
+    Training sets smaller than `exact_below` rows are searched exactly.
+    `n_lists` defaults to about sqrt(n_samples) cells.
+    """
+    def __init__(self, n_neighbors=1, n_lists=None, n_probe=8, exact_below=5000, n_iter=10, batch_size=2048,
+                 random_state=0):
+        self.n_neighbors = n_neighbors
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.exact_below = exact_below
+        self.n_iter = n_iter
+        self.batch_size = batch_size
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        self.classes_, y = np.unique(y, return_inverse=True)
+        self.exact_ = len(X) < self.exact_below
+        if self.exact_:
+            self.X_, self.y_ = X, y
+            self.centroids_ = X.mean(axis=0, keepdims=True)
+            self.offsets_ = np.array([0, len(X)])
+        else:
+            n_lists = self.n_lists or int(np.sqrt(len(X)))
+            self.centroids_ = kmeans(X, n_lists, self.n_iter, random_state=self.random_state)
+            lists = np.argmin(squared_distances(X, self.centroids_), axis=1)
+            # Rows are stored grouped by cell, cell c is X_[offsets_[c]:offsets_[c + 1]].
+            order = np.argsort(lists, kind='stable')
+            self.X_, self.y_ = X[order], y[order]
+            self.offsets_ = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=n_lists))])
+        self.norms_ = np.einsum('ij,ij->i', self.X_, self.X_)
+        return self
+
+    def kneighbors(self, X):
+        """Squared distances and indices (into the stored rows) of the approximate nearest neighbors."""
+        check_is_fitted(self)
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        k = min(self.n_neighbors, len(self.X_))
+        distances = np.full((len(X), k), np.inf, dtype=np.float32)
+        indices = np.zeros((len(X), k), dtype=np.int64)
+        for start in range(0, len(X), self.batch_size):
+            batch = slice(start, start + self.batch_size)
+            self.search(X[batch], distances[batch], indices[batch])
+        return distances, indices
+
+    def search(self, Q, distances, indices):
+        n_lists = len(self.centroids_)
+        n_probe = min(self.n_probe, n_lists)
+        if n_probe < n_lists:
+            probes = np.argpartition(squared_distances(Q, self.centroids_), n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            probes = np.broadcast_to(np.arange(n_lists), (len(Q), n_lists))
+        k = distances.shape[1]
+        for c in np.unique(probes):
+            begin, end = self.offsets_[c], self.offsets_[c + 1]
+            if begin == end:
+                continue
+            queries = np.nonzero((probes == c).any(axis=1))[0]
+            d = squared_distances(Q[queries], self.X_[begin:end], self.norms_[begin:end])
+            # Merge the cell's candidates into the running k best of each query.
+            d = np.concatenate([distances[queries], d], axis=1)
+            i = np.concatenate([indices[queries], np.broadcast_to(np.arange(begin, end), (len(queries), end - begin))],
+                               axis=1)
+            best = np.argpartition(d, k - 1, axis=1)[:, :k]
+            distances[queries] = np.take_along_axis(d, best, axis=1)
+            indices[queries] = np.take_along_axis(i, best, axis=1)
+
+    def predict_proba(self, X):
+        _, indices = self.kneighbors(X)
+        votes = np.zeros((len(indices), len(self.classes_)))
+        np.add.at(votes, (np.arange(len(indices))[:, None], self.y_[indices]), 1)
+        return votes / indices.shape[1]
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+def compare_exact(X_train, y_train, X_test, y_test, **params):
+    """Accuracy, query time and neighbor recall of the IVF classifier against exact search.
+
+    Recall is the share of test rows whose approximate nearest neighbor is the exact one.
+    """
+    ann = IVFKNeighborsClassifier(**params)
+    exact = KNeighborsClassifier(ann.n_neighbors, algorithm='brute')
+    results = {}
+    for name, clf in [('exact', exact), ('ivf', ann)]:
+        start = time.perf_counter()
+        clf.fit(X_train, y_train)
+        results[f'{name}_fit_time'] = time.perf_counter() - start
+        start = time.perf_counter()
+        results[f'{name}_accuracy'] = np.mean(clf.predict(X_test) == np.asarray(y_test))
+        results[f'{name}_query_time'] = time.perf_counter() - start
+    results['accuracy_diff'] = results['ivf_accuracy'] - results['exact_accuracy']
+
+    exact_distances, _ = exact.kneighbors(X_test, n_neighbors=1)
+    ivf_distances, _ = ann.kneighbors(X_test)
+    # Compared by distance, ties between equally close rows count as found.
+    found = np.sqrt(ivf_distances.min(axis=1)) <= exact_distances[:, 0] * (1 + 1e-4) + 1e-4
+    results['recall'] = np.mean(found)
+    return results
+
+if __name__ == "__main__":
+    import os, sys
+    parent_dir = os.path.abspath(os.path.join(os.getcwd(), "."))
+    sys.path.append(parent_dir)
+    import pandas as pd
+    from sklearn.preprocessing import StandardScaler
+    from stack import read_feature_blocks
+    from splits import train_test_indices
+
+    mf = '40X'
+    rows = []
+    for extractor in ['resnet18', 'googlenet']:
+        fnames, X, y, _ = read_feature_blocks([extractor], root='features/store/', mf=mf)
+        train, test = train_test_indices(fnames, y, mf)
+        scaler = StandardScaler().fit(X[train])
+        X_train, X_test = scaler.transform(X[train]), scaler.transform(X[test])
+        for n_probe in [1, 4, 8, 16]:
+            # exact_below=0 so the index is used on BreaKHis-sized folds too.
+            rows.append({'extractor': extractor, 'n_probe': n_probe,
+                         **compare_exact(X_train, y[train], X_test, y[test], n_probe=n_probe, exact_below=0)})
+    print(pd.DataFrame(rows).to_string())
@@ -7,7 +7,13 @@ sys.path.append(parent_dir)
 # print(sys.path)
 # Now we can import the tools module
 import numpy as np
-from stack import read_features, split_data, read_data
+from stack import read_features, read_feature_blocks, split_data, read_data
+from features.feature_store import FeatureStore
+from folds import FoldCache
+from metrics import PredictionScorer, patient_recognition_rate, null_accuracy
+from significance import compare, fold_sizes
+from ann import IVFKNeighborsClassifier
+from splits import PatientKFold
 
 from sklearn.metrics import accuracy_score, roc_auc_score, precision_score, average_precision_score, f1_score, cohen_kappa_score, recall_score, log_loss
 from sklearn.metrics import make_scorer
@@ -40,11 +46,18 @@ from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis
 from sklearn.svm import SVC, NuSVC, LinearSVC
 from sklearn.mixture import GaussianMixture
 
-from sklearn.model_selection import StratifiedKFold
+from sklearn.model_selection import StratifiedKFold, train_test_split
 from sklearn.preprocessing import StandardScaler
+from sklearn.base import clone
 import pandas as pd
 from tqdm import tqdm
 import re
+import time
+import json
+import tempfile
+import multiprocessing
+import multiprocessing.connection
+from threadpoolctl import threadpool_limits
 
 def extract_text_between_parentheses(string):
     pattern = r'\((.*?)\)'  # Regular expression pattern to match text between parentheses
@@ -62,6 +75,8 @@ classifiers = [
                 ExtraTreesClassifier(criterion='entropy', n_estimators=100, random_state=0),
                 # GaussianProcessClassifier(kernel=1.0 * RBF(1.0), random_state=0),
                 KNeighborsClassifier(1),
+                # Approximate 1-NN for the CNN blocks, see ann.compare_exact for its accuracy against exact search.
+                # IVFKNeighborsClassifier(1, n_probe=8),
                 # SVC(kernel="linear", C=1),
                 # SVC(gamma='auto', C=1),   
                 DecisionTreeClassifier(criterion='entropy', max_depth=20),
@@ -100,37 +115,212 @@ def custom_score(y_true, y_pred, fn=accuracy_score):
     return fn(y_true, y_pred_binary)
 
 
-cv_metrics = {
-    'accuracy_score': make_scorer(accuracy_score),
-    'cross_entropy_loss': make_scorer(log_loss),
-    'average_precision_score' : make_scorer(average_precision_score, average='weighted'),
-    'cohen_kappa_score' : make_scorer(cohen_kappa_score),
-    'f1_score' : make_scorer(f1_score, average='weighted'),
-    'recall_score' : make_scorer(recall_score, average='weighted'),
-    'roc_auc_score': make_scorer(roc_auc_score, average='weighted'),
-    'specificity_score' : make_scorer(recall_score, pos_label=0, average='binary'),
-}
+# Every metric is computed from one predict (and one predict_proba or decision_function) per split,
+# ranking metrics and the log loss use the continuous outputs when the classifier has them.
+cv_metrics = PredictionScorer({
+    'accuracy_score': (accuracy_score, 'label', {}),
+    'cross_entropy_loss': (log_loss, 'proba', {}),
+    'average_precision_score' : (average_precision_score, 'score', {'average': 'weighted'}),
+    'cohen_kappa_score' : (cohen_kappa_score, 'label', {}),
+    'f1_score' : (f1_score, 'label', {'average': 'weighted'}),
+    'recall_score' : (recall_score, 'label', {'average': 'weighted'}),
+    'roc_auc_score': (roc_auc_score, 'score', {'average': 'weighted', 'multi_class': 'ovr'}),
+    'specificity_score' : (recall_score, 'label', {'pos_label': 0, 'average': 'binary'}),
+    'patient_recognition_rate': (patient_recognition_rate, 'patient', {}),
+})
+
+# Fold cache and BLAS limits of the current sweep worker, set once by the pool initializer.
+worker_folds = None
+worker_limits = None
+
+def init_worker(folds, threads_per_job=1):
+    """Receive the fold cache once per worker and cap its BLAS/OpenMP pools to `threads_per_job` threads."""
+    global worker_folds, worker_limits
+    worker_folds = folds
+    worker_limits = threadpool_limits(limits=threads_per_job)
+
+def fit_fold(clf, k, scoring, n_samples=None):
+    """Fit one classifier on fold k of the cache, with the same result keys as cross_validate.
+
+    `n_samples` fits on a fixed random subset of the fold's training rows, stratified on the labels.
+    """
+    X_train, X_test, y_train, y_test = worker_folds.fold(k)
+    fnames_train, fnames_test = worker_folds.fold_fnames(k)
+    if n_samples is not None and n_samples < len(y_train):
+        try:
+            rows, _ = train_test_split(np.arange(len(y_train)), train_size=n_samples, stratify=y_train, random_state=k)
+        except ValueError:
+            # A class with a single row cannot be stratified.
+            rows = np.random.RandomState(k).permutation(len(y_train))[:n_samples]
+        rows = np.sort(rows)
+        X_train, y_train = X_train[rows], y_train[rows]
+        fnames_train = None if fnames_train is None else fnames_train[rows]
+    clf = clone(clf)
+    scores = {}
+    try:
+        start = time.perf_counter()
+        clf.fit(X_train, y_train)
+        scores['fit_time'] = time.perf_counter() - start
+        start = time.perf_counter()
+        for name, value in scoring(clf, X_test, y_test, fnames=fnames_test).items():
+            scores[f'test_{name}'] = value
+        scores['score_time'] = time.perf_counter() - start
+        for name, value in scoring(clf, X_train, y_train, fnames=fnames_train).items():
+            scores[f'train_{name}'] = value
+    except Exception as e:
+        # Same as cross_validate's error_score=np.nan, a failing fit does not stop the sweep.
+        print(f"{clf} failed: {e}")
+        for name in scoring:
+            scores.setdefault(f'test_{name}', np.nan)
+            scores.setdefault(f'train_{name}', np.nan)
+    return scores
+
+def run_job(connection, folds, clf, k, scoring, threads_per_job, n_samples=None):
+    """Body of a job process, sends the fold scores back to the sweep."""
+    init_worker(folds, threads_per_job)
+    connection.send(fit_fold(clf, k, scoring, n_samples))
+    connection.close()
+
+def stop_jobs(running):
+    for process, (_, receiver, _) in running.items():
+        process.terminate()
+        process.join()
+        receiver.close()
+    running.clear()
+
+def run_jobs(jobs, scoring, n_jobs=None, threads_per_job=1, timeout=None, deadline=None):
+    """Run (key, classifier, fold, fold cache) jobs, at most n_jobs at a time, and yield (job, scores, status) as they finish.
+
+    Every job gets its own process so that one running longer than `timeout`
+    seconds can be terminated. The status is 'done', or 'stopped' for a
+    terminated job and 'crashed' for a process that died, both with empty scores. A job may
+    carry a fifth item, the number of training rows to subsample (see fit_fold).
+    Once time.perf_counter() passes `deadline`, the running jobs are terminated
+    and the pending ones dropped, neither is yielded. Closing the generator
+    early terminates the running jobs as well.
+    """
+    n_jobs = n_jobs or os.cpu_count()
+    pending = list(jobs)
+    running = {}
+    try:
+        while pending or running:
+            if deadline is not None and time.perf_counter() > deadline:
+                return
+            while pending and len(running) < n_jobs:
+                job = pending.pop(0)
+                _, clf, k, folds = job[:4]
+                n_samples = job[4] if len(job) > 4 else None
+                receiver, sender = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=run_job, args=(sender, folds, clf, k, scoring, threads_per_job, n_samples),
+                                                  daemon=True)
+                process.start()
+                sender.close()
+                running[process] = (job, receiver, time.perf_counter())
+
+            ready = multiprocessing.connection.wait([receiver for _, receiver, _ in running.values()], timeout=0.5)
+            for process, (job, receiver, start) in list(running.items()):
+                if receiver in ready:
+                    try:
+                        scores, status = receiver.recv(), 'done'
+                    except EOFError:
+                        # The process died without answering, e.g. killed for memory.
+                        print(f"{job[0]} fold {job[2]} crashed with exit code {process.exitcode}.")
+                        scores, status = {}, 'crashed'
+                elif timeout is not None and time.perf_counter() - start > timeout:
+                    process.terminate()
+                    print(f"{job[0]} fold {job[2]} stopped after {timeout}s.")
+                    scores, status = {}, 'stopped'
+                else:
+                    continue
+                process.join()
+                receiver.close()
+                del running[process]
+                yield job, scores, status
+    finally:
+        stop_jobs(running)
+
+def read_checkpoint(path, key, timeout=None):
+    """Fold scores already settled for the same folds, by (classifier, fold).
+
+    Jobs stopped after a timeout at least as long as `timeout` are settled with
+    empty scores, so a slow model is not run again just to be stopped again;
+    with a longer (or no) timeout they are run again. Crashed jobs are never recorded.
+    """
+    done = {}
+    if path is not None and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record['folds'] != key:
+                    continue
+                status = record.get('status', 'done' if record['scores'] else None)
+                if status == 'done' or (status == 'stopped' and timeout is not None and record['timeout'] >= timeout):
+                    done[(record['classifier'], record['fold'])] = record['scores']
+    return done
+
+def write_checkpoint(path, key, clf_key, k, scores, status='done', timeout=None):
+    if path is None or status == 'crashed':
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps({'folds': key, 'classifier': clf_key, 'fold': k, 'status': status, 'timeout': timeout,
+                            'scores': {name: float(value) for name, value in scores.items()}}) + '\n')
+
+def sweep(classifiers, folds, scoring, n_jobs=None, threads_per_job=1, timeout=None, checkpoint=None):
+    """Run every (classifier, fold) pair of a FoldCache as an independent job.
+
+    The folds are already standardized, so the classifiers are fitted as they are.
+    Each job is stopped after `timeout` seconds. Finished and stopped jobs are
+    appended to the `checkpoint` file, so a rerun only fits the missing ones,
+    crashed jobs and the jobs stopped with a shorter timeout (see read_checkpoint).
+    Returns the per-fold scores of every classifier, as cross_validate would, NaN for stopped jobs.
+    """
+    done = read_checkpoint(checkpoint, folds.key, timeout)
+    results = {str(clf): [done.get((str(clf), k)) for k in range(len(folds))] for clf in classifiers}
+    jobs = [(str(clf), clf, k, folds) for clf in classifiers for k in range(len(folds)) if results[str(clf)][k] is None]
+    if len(done):
+        print(f"Resuming from {checkpoint}: {len(jobs)} of {len(classifiers) * len(folds)} jobs left.")
+
+    for (clf_key, _, k, _), scores, status in tqdm(run_jobs(jobs, scoring, n_jobs, threads_per_job, timeout),
+                                                total=len(jobs), desc="Classifiers are running...."):
+        results[clf_key][k] = scores
+        write_checkpoint(checkpoint, folds.key, clf_key, k, scores, status, timeout)
+
+    keys = ['fit_time', 'score_time'] + [f'{split}_{name}' for name in scoring for split in ['test', 'train']]
+    return {clf_key: {key: np.array([fold.get(key, np.nan) for fold in scores]) for key in keys}
+            for clf_key, scores in results.items()}
 
 # TODO: Try with MNIST
 # You can try to list parameters of classifier here.
-def eval_classifiers(X, y, **kwargs):
-    """Pseudo -code. Do not RUN yet."""
+def eval_classifiers(X, y, n_jobs=None, threads_per_job=1, cache_dir=None, timeout=None, checkpoint=None, fnames=None, cv=None,
+                     **kwargs):
+    """Cross-validate every classifier, with the (classifier, fold) jobs spread over `n_jobs` processes.
+
+    Each worker is limited to `threads_per_job` BLAS threads, so n_jobs * threads_per_job
+    should not exceed the number of cores. The standardized folds are computed once
+    for all classifiers and kept as memory-mapped files under `cache_dir`, or under a
+    temporary directory (removed afterwards) so the job processes never receive them pickled.
+    A (classifier, fold) job is stopped after `timeout` seconds, and every finished
+    job is appended to `checkpoint`, from which an interrupted run resumes.
+    With the image `fnames`, the patient recognition rate is reported as well.
+    `cv` defaults to the saved patient-grouped folds of splits.py when the fnames and
+    info['mf'] are given, and to a plain StratifiedKFold otherwise.
+    """
     # Example classifiers: https://scikit-learn.org/stable/auto_examples/classification/plot_classifier_comparison.html 
     # Define the list of scoring metrics
     df = pd.DataFrame()
     df_std = pd.DataFrame()
-    
-    for i, clf in tqdm(enumerate(classifiers), desc="Classifiers are running...."):
-        # ax = plt.subplot(len(classifiers) + 1, i)
-        clf_key = str(clf)
-        clf = make_pipeline(StandardScaler(), clf)
 
-        # Apply cross-validated model here.
-        cv = StratifiedKFold(n_splits=10)  # Specify the number of desired folds
-        cv_scores = cross_validate(clf, X, y, cv=cv, scoring=cv_metrics, return_train_score=True)  # Specify the list of scoring metrics
-        # print(cv_scores)
-        # print(np.array(cv_scores.values()))
+    # Apply cross-validated model here.
+    mf = kwargs.get('info', {}).get('mf')
+    if cv is None:
+        # Specify the number of desired folds
+        cv = PatientKFold(fnames, mf) if fnames is not None and mf is not None else StratifiedKFold(n_splits=10)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        folds = FoldCache(np.asarray(X), y, cv, root=cache_dir or tmp_dir, fnames=fnames)
+        cv_results = sweep(classifiers, folds, cv_metrics, n_jobs, threads_per_job, timeout, checkpoint)
 
+    for clf_key, cv_scores in cv_results.items():
         # Use sklearn metrics AUC.
         for j, key in enumerate(cv_scores.keys()):
             df.loc[clf_key, key] = np.mean(cv_scores[key])
@@ -148,17 +338,30 @@ def eval_classifiers(X, y, **kwargs):
 
     df.to_csv(filename)
     df_std.to_csv("40X_std.csv")
+
+    # Ranked table with bootstrap intervals and corrected t-tests against the best classifier and the null accuracy.
+    significance = compare(cv_results, *fold_sizes(folds), metric='test_accuracy_score', baseline=null_accuracy(None, y))
+    significance.to_csv(filename.replace('.csv', '_significance.csv'), index=False)
     return df
 
 if __name__ == "__main__":
 
     mf = '100X'
     extractors = ['glcm', 'hos','lbp', 'lpq', 'orb', 'wpd', 'hog', 'resnet18', 'googlenet']
+    # Train on the reduced blocks written by features/reduction.py where they exist, e.g. 'pca64'.
+    reduction = None
+    if reduction is not None:
+        stored = FeatureStore(f'features/store/{mf}/').extractors()
+        extractors = [f'{e}_{reduction}' if f'{e}_{reduction}' in stored else e for e in extractors]
 
     # Stack is throuple of image, multiclass/binary label, filename.
     # stack = read_data('../BreaKHis_v1/', '40X', mode = 'multiclass', shuffle=True, imsize=None)
 
-    fnames, X, y_binary = read_features(extractors, root='features/all/', mf=mf)
+    # Prefer the binary feature store, fall back to the per-extractor CSVs.
+    if set(extractors) <= set(FeatureStore(f'features/store/{mf}/').extractors()):
+        fnames, X, y_binary, spans = read_feature_blocks(extractors, root='features/store/', mf=mf)
+    else:
+        fnames, X, y_binary = read_features(extractors, root='features/all/', mf=mf)
 
     fnames = list(fnames)
 
@@ -181,6 +384,17 @@ if __name__ == "__main__":
     # y_multiclass_num = [np.argmax(y) for y in y_negative_multiclass]
 
     # # X_train, X_test, y_train, y_test = split_data(X, y_multiclass, one_hot_vector=False, test_size=0.3)
-    performance = eval_classifiers(X, y_binary, info={'extractors': extractors,'mode': 'binary', 'mf': mf})
+    # Tune the slow models (SVC, gradient boosting, MLP...) by successive halving within a budget in seconds,
+    # and add the best configurations to the sweep.
+    search_budget = None
+    if search_budget is not None:
+        from search import search_classifiers
+        folds = FoldCache(np.asarray(X), y_binary, PatientKFold(fnames, mf), root=f'classifiers/cache/{mf}/folds/', fnames=fnames)
+        best, history = search_classifiers(folds, time_budget=search_budget, cache_path=f'classifiers/cache/{mf}/search.jsonl')
+        classifiers.extend(best.values())
+
+    performance = eval_classifiers(X, y_binary, cache_dir=f'classifiers/cache/{mf}/folds/', timeout=1800, fnames=fnames,
+                                   checkpoint=f'classifiers/cache/{mf}/{"".join(extractors)}_checkpoint.jsonl',
+                                   info={'extractors': extractors,'mode': 'binary', 'mf': mf})
     # print(performance)
 
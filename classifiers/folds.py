@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+
+def data_key(X, y, folds):
+    """Hash of the data and the fold indices, a cache is only reused for the same inputs."""
+    digest = hashlib.sha1()
+    digest.update(str(X.shape).encode())
+    for start in range(0, len(X), 4096):
+        digest.update(np.ascontiguousarray(X[start:start + 4096]).tobytes())
+    digest.update(np.asarray(y).tobytes())
+    for train, test in folds:
+        digest.update(train.tobytes())
+        digest.update(test.tobytes())
+    return digest.hexdigest()[:12]
+
+class FoldCache():
+    """Fold indices and standardized fold matrices, computed once and shared by every classifier.
+
+    The scaler is fitted once per fold on its training rows, so classifiers can
+    be fitted on the cached matrices without a StandardScaler in their pipeline.
+    With `root`, every fold is written as .npy files
+
+        root/fold_00_train.npy, root/fold_00_test.npy     standardized rows
+        root/folds.npz                                     train/test indices and labels
+
+    which workers open memory-mapped: the pages are shared between processes
+    instead of being pickled to each of them. A cache with a root pickles as its
+    root alone, so a job process only receives the path and reloads the fold
+    indices from folds.npz. Without `root`, the folds stay in memory and are pickled whole.
+    The image names, if given, are kept for the patient-level metrics.
+    """
+    def __init__(self, X, y, cv, root=None, scale=True, fnames=None):
+        self.root = root
+        self.scale = scale
+        self.fnames = None if fnames is None else np.asarray(fnames)
+        y = np.asarray(y)
+        self.folds = [(train, test) for train, test in cv.split(X, y)]
+        self.y = y
+        self.key = data_key(X, y, self.folds)
+        self.matrices = None
+        if root is None:
+            self.matrices = [self.standardize(X, train, test) for train, test in self.folds]
+        else:
+            self.build(X, y)
+
+    def __len__(self):
+        return len(self.folds)
+
+    def __getstate__(self):
+        if self.root is None:
+            return self.__dict__
+        return {'root': self.root, 'scale': self.scale, 'key': self.key}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.root is not None and 'folds' not in state:
+            saved = np.load(self.path('folds.npz'), allow_pickle=False)
+            n_folds = len([name for name in saved.files if name.startswith('test_')])
+            self.folds = [(saved[f'train_{k}'], saved[f'test_{k}']) for k in range(n_folds)]
+            self.y = saved['y']
+            self.fnames = saved['fnames'] if 'fnames' in saved.files else None
+            self.matrices = None
+
+    def standardize(self, X, train, test):
+        X_train, X_test = X[train], X[test]
+        if self.scale:
+            scaler = StandardScaler().fit(X_train)
+            X_train, X_test = scaler.transform(X_train), scaler.transform(X_test)
+        return X_train, X_test
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def build(self, X, y):
+        """Write the folds, unless the root already holds them for the same data."""
+        meta_path = self.path('meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['key'] == self.key and meta['scale'] == self.scale and \
+                    meta.get('fnames', False) == (self.fnames is not None):
+                return
+
+        os.makedirs(self.root, exist_ok=True)
+        for k, (train, test) in enumerate(self.folds):
+            X_train, X_test = self.standardize(X, train, test)
+            np.save(self.path(f'fold_{k:02d}_train.npy'), X_train)
+            np.save(self.path(f'fold_{k:02d}_test.npy'), X_test)
+        np.savez(self.path('folds.npz'), y=y, **{f'train_{k}': train for k, (train, _) in enumerate(self.folds)},
+                 **{f'test_{k}': test for k, (_, test) in enumerate(self.folds)},
+                 **({} if self.fnames is None else {'fnames': self.fnames.astype(str)}))
+        # The meta file is written last, an interrupted build is redone.
+        with open(meta_path, 'w') as f:
+            json.dump({'key': self.key, 'scale': self.scale, 'folds': len(self.folds), 'shape': list(X.shape),
+                       'fnames': self.fnames is not None}, f)
+
+    def columns(self, spans):
+        """The same folds restricted to column spans, see ColumnFolds."""
+        return ColumnFolds(self, spans)
+
+    def fold_fnames(self, k):
+        """Image names of the training and test rows of fold k, None if unknown."""
+        if self.fnames is None:
+            return None, None
+        train, test = self.folds[k]
+        return self.fnames[train], self.fnames[test]
+
+    def fold(self, k):
+        """X_train, X_test, y_train, y_test of fold k."""
+        train, test = self.folds[k]
+        if self.matrices is not None:
+            X_train, X_test = self.matrices[k]
+        else:
+            X_train = np.load(self.path(f'fold_{k:02d}_train.npy'), mmap_mode='r')
+            X_test = np.load(self.path(f'fold_{k:02d}_test.npy'), mmap_mode='r')
+        return X_train, X_test, self.y[train], self.y[test]
+
+class ColumnFolds():
+    """Column subset of a FoldCache, e.g. the blocks of one extractor combination.
+
+    Standardization is per column, so the standardized folds of the full
+    matrix restricted to some columns are the standardized folds of those
+    columns. Adjacent (start, end) spans are merged, and a subset that is a
+    single span is served as a view of the cached matrices without a copy;
+    other subsets are gathered per fold when a job reads them.
+    """
+    def __init__(self, folds, spans):
+        merged = []
+        for start, end in sorted(spans):
+            if merged and merged[-1][1] == start:
+                merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        self.base = folds
+        self.spans = merged
+        self.folds = folds.folds
+        self.y = folds.y
+        self.scale = folds.scale
+        self.fnames = folds.fnames
+        self.key = f'{folds.key}:' + ','.join(f'{start}-{end}' for start, end in merged)
+
+    def __len__(self):
+        return len(self.folds)
+
+    def __getstate__(self):
+        # The shared attributes come back from the base cache, which pickles as its root.
+        return {'base': self.base, 'spans': self.spans, 'key': self.key}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.folds, self.y = self.base.folds, self.base.y
+        self.scale, self.fnames = self.base.scale, self.base.fnames
+
+    def fold_fnames(self, k):
+        return self.base.fold_fnames(k)
+
+    def select(self, X):
+        if len(self.spans) == 1:
+            return X[:, self.spans[0][0]:self.spans[0][1]]
+        return np.concatenate([X[:, start:end] for start, end in self.spans], axis=1)
+
+    def fold(self, k):
+        X_train, X_test, y_train, y_test = self.base.fold(k)
+        return self.select(X_train), self.select(X_test), y_train, y_test
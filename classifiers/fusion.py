@@ -0,0 +1,78 @@
+"""Feature fusion evaluation: compare extractor combinations in one run.
+
+Every extractor block is read from the feature store once into a single
+matrix and standardized once per fold (FoldCache). A combination is a set of
+column spans of that matrix (ColumnFolds), so no block is reloaded or
+rescaled per combination, and the (combination, classifier, fold) jobs of all
+combinations share one job queue.
+"""
+import itertools
+import tempfile
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from classifiers import classifiers, cv_metrics, run_jobs, read_checkpoint, write_checkpoint
+from stack import read_feature_blocks
+from folds import FoldCache
+from splits import PatientKFold
+
+def combinations_of(extractors, sizes=(1, 2)):
+    """All combinations of the extractors with the given numbers of blocks."""
+    return [combo for size in sizes for combo in itertools.combinations(extractors, size)]
+
+def eval_fusion(combinations, root='features/store/', mf='40X', classifiers=classifiers, n_jobs=None, threads_per_job=1,
+                cache_dir=None, timeout=None, checkpoint=None, n_splits=10):
+    """Cross-validate every classifier on every combination of extractor blocks.
+
+    Returns one table with a row per distinct combination and classifier, the mean of every
+    cross_validate key and its standard deviation in a `<key>_std` column.
+    Without `cache_dir` the fold matrices are memory-mapped from a temporary directory.
+    """
+    # A combination is a set of blocks, permutations of one (A+B, B+A) are evaluated once, under the first name given.
+    unique = {}
+    for combo in combinations:
+        combo = tuple(dict.fromkeys(str(e) for e in combo))
+        unique.setdefault(frozenset(combo), combo)
+    combinations = list(unique.values())
+    extractors = list(dict.fromkeys(e for combo in combinations for e in combo))
+    fnames, X, y, spans = read_feature_blocks(extractors, root=root, mf=mf)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        folds = FoldCache(X, y, PatientKFold(fnames, mf, n_splits), root=cache_dir or tmp_dir, fnames=fnames)
+
+        views = {'+'.join(combo): folds.columns([spans[e] for e in combo]) for combo in combinations}
+        results, jobs = {}, []
+        for name, view in views.items():
+            done = read_checkpoint(checkpoint, view.key, timeout)
+            for clf in classifiers:
+                results[(name, str(clf))] = [done.get((str(clf), k)) for k in range(len(folds))]
+                jobs += [(f'{name}: {clf}', clf, k, view) for k in range(len(folds))
+                         if results[(name, str(clf))][k] is None]
+
+        names = {view.key: name for name, view in views.items()}
+        for (_, clf, k, view), scores, status in tqdm(run_jobs(jobs, cv_metrics, n_jobs, threads_per_job, timeout),
+                                                      total=len(jobs), desc="Combinations are running...."):
+            results[(names[view.key], str(clf))][k] = scores
+            write_checkpoint(checkpoint, view.key, str(clf), k, scores, status, timeout)
+
+    keys = ['fit_time', 'score_time'] + [f'{split}_{name}' for name in cv_metrics for split in ['test', 'train']]
+    rows = []
+    for (name, clf_key), scores in results.items():
+        row = {'combination': name, 'classifier': clf_key,
+               'features': sum(end - start for start, end in views[name].spans)}
+        for key in keys:
+            values = np.array([fold.get(key, np.nan) for fold in scores])
+            row[key] = np.mean(values)
+            row[f'{key}_std'] = np.std(values)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+if __name__ == "__main__":
+    mf = '100X'
+    extractors = ['glcm', 'hos', 'lbp', 'lpq', 'orb', 'wpd', 'hog', 'resnet18', 'googlenet']
+
+    # Every single block, every pair and all blocks together.
+    combinations = combinations_of(extractors, sizes=(1, 2)) + [tuple(extractors)]
+    table = eval_fusion(combinations, root='features/store/', mf=mf, cache_dir=f'classifiers/cache/{mf}/folds/',
+                        timeout=1800, checkpoint=f'classifiers/cache/{mf}/fusion_checkpoint.jsonl')
+    table.to_csv(f'classifiers/results/binary/{mf}/fusion_{mf}binary.csv', index=False)
@@ -1,9 +1,18 @@
-# TODO: Pattern Recognition Rate calculation
-
 # TODO: AUC / Accuracy / F1 Score etc.
+import os
+import sys
+import warnings
 import numpy as np
+import pandas as pd
 
 from scipy import stats
+from sklearn.preprocessing import label_binarize
+
+# Get the parent directory path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), "."))
+# Add the parent directory to the Python path
+sys.path.append(parent_dir)
+from tools import patient_ids
  
 
 
@@ -12,22 +21,90 @@ def null_accuracy(acc, y):
 
     null_acc = np.max(len_classes) / len(y)
     
-    # t_value, p_value = stats.ttest_ind(null_acc, acc, equal_var=False)
+    # Per-fold accuracies are compared to it with significance.corrected_ttest.
 
     return null_acc
 
-##PSEUDO CODE
-def patient_recognition_rate(img_names, y, y_pred):
-    
-    patients = {"ID1": imgs_list_of_indices}
-    ... # Calculate the number of patients
-    
-    for patient, imgs_list in patients:
-        patient_score = 0
-        for i in imgs_list:
-            if y[i] == y_pred[i]:
-                nrec +=  1
-            if y[i] == 1:
-                np += 1
-
-    return sum(patient_score)/len(patients)
\ No newline at end of file
+def continuous_outputs(estimator, X):
+    """Class probabilities, else decision values, of an estimator, None if it has neither."""
+    for method in ['predict_proba', 'decision_function']:
+        if hasattr(estimator, method):
+            try:
+                return method, getattr(estimator, method)(X)
+            except (AttributeError, NotImplementedError):
+                # e.g. SVC(probability=False) or losses without probabilities.
+                continue
+    return None, None
+
+class PredictionScorer():
+    """Computes several metrics from a single prediction of the estimator per split.
+
+    `metrics` maps a name to (metric function, input, keyword arguments), where
+    the input is 'label' for the predicted labels, 'proba' for class
+    probabilities, 'score' for probabilities or decision values and 'patient'
+    for the image names with the predicted labels, NaN when no names are given.
+    Estimators without the requested continuous output fall back to predicted labels.
+    Calling the scorer returns a dict of scores, the same as a multi-metric
+    callable for sklearn's cross_validate.
+    """
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def __iter__(self):
+        return iter(self.metrics)
+
+    def __call__(self, estimator, X, y, fnames=None):
+        y = np.asarray(y)
+        y_pred = estimator.predict(X)
+        needs = {needed for _, needed, _ in self.metrics.values()}
+        method, outputs = continuous_outputs(estimator, X) if needs - {'label', 'patient'} else (None, None)
+        classes = getattr(estimator, 'classes_', np.unique(y))
+
+        scores = {}
+        for name, (fn, needed, kwargs) in self.metrics.items():
+            try:
+                if needed == 'patient':
+                    scores[name] = np.nan if fnames is None else fn(fnames, y, y_pred, **kwargs)
+                elif needed == 'label' or outputs is None or (needed == 'proba' and method != 'predict_proba'):
+                    scores[name] = fn(y, y_pred, **kwargs)
+                else:
+                    scores[name] = fn(*self.score_inputs(fn, y, outputs, classes), **kwargs)
+            except ValueError as e:
+                # A metric that does not apply, e.g. a binary one on multiclass labels, only loses its own column.
+                warnings.warn(f"{name} failed: {e}")
+                scores[name] = np.nan
+        return scores
+
+    @staticmethod
+    def score_inputs(fn, y, outputs, classes):
+        """Binary problems use the positive class column, multiclass ranking metrics a binarized y."""
+        if len(classes) == 2:
+            return y, outputs[:, 1] if outputs.ndim == 2 else outputs
+        if fn.__name__ == 'average_precision_score':
+            return label_binarize(y, classes=classes), outputs
+        return y, outputs
+
+def recognition_rates(fnames, y, y_pred):
+    """Image-level and patient-level recognition rates of the BreaKHis protocol.
+
+    The image recognition rate is the share of correctly classified images. The
+    patient score is the share of correctly classified images of a patient and
+    the patient recognition rate is the mean patient score, computed in one pass
+    with bincount over the factorized patient ids.
+    """
+    patients, _ = pd.factorize(patient_ids(fnames))
+    correct = np.asarray(y) == np.asarray(y_pred)
+    patient_scores = np.bincount(patients, weights=correct) / np.bincount(patients)
+    return correct.mean(), patient_scores.mean()
+
+def image_recognition_rate(fnames, y, y_pred):
+    return recognition_rates(fnames, y, y_pred)[0]
+
+def patient_recognition_rate(fnames, y, y_pred):
+    return recognition_rates(fnames, y, y_pred)[1]
+
+def patient_scores(fnames, y, y_pred):
+    """Per-patient table of images, correctly classified images and patient score."""
+    correct = np.asarray(y) == np.asarray(y_pred)
+    scores = pd.DataFrame({'patient': patient_ids(fnames), 'correct': correct}).groupby('patient')['correct']
+    return pd.DataFrame({'images': scores.size(), 'correct': scores.sum(), 'score': scores.mean()})
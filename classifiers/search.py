@@ -0,0 +1,170 @@
+"""Successive-halving hyperparameter search for the classifier zoo.
+
+Every configuration sampled from a parameter space starts on a small share of
+the training rows and of the folds, and only the best 1/factor of them moves
+on to the next round with `factor` times more rows and folds, until the last
+round uses the full folds. (candidate, fold, rows) jobs run as terminable
+processes on the shared FoldCache, as in the classifier sweep, and their scores are cached
+so an interrupted or repeated search only fits what it has not seen.
+"""
+import os
+import json
+import math
+import time
+import numpy as np
+import pandas as pd
+from scipy.stats import loguniform, randint, uniform
+from sklearn.base import clone
+from sklearn.model_selection import ParameterSampler
+from sklearn.svm import SVC
+from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+from sklearn.neural_network import MLPClassifier
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.linear_model import LogisticRegression
+
+from classifiers import run_jobs, cv_metrics
+from stack import read_feature_blocks
+from folds import FoldCache
+from splits import PatientKFold
+
+# The models that are too slow for a full grid, and the ones of the sweep worth tuning.
+param_spaces = {
+    'svc': (SVC(), {'C': loguniform(1e-2, 1e2), 'gamma': loguniform(1e-4, 1e-1), 'kernel': ['rbf', 'linear']}),
+    'gradient_boosting': (GradientBoostingClassifier(random_state=0),
+                          {'n_estimators': randint(50, 300), 'learning_rate': loguniform(1e-2, 3e-1),
+                           'max_depth': randint(2, 6), 'subsample': uniform(0.6, 0.4)}),
+    'mlp': (MLPClassifier(max_iter=1000, random_state=0),
+            {'hidden_layer_sizes': [(64,), (128,), (256,), (128, 64)], 'alpha': loguniform(1e-5, 1),
+             'learning_rate_init': loguniform(1e-4, 1e-2)}),
+    'random_forest': (RandomForestClassifier(criterion='entropy', random_state=0),
+                      {'n_estimators': randint(50, 400), 'max_depth': [None, 10, 20, 40],
+                       'max_features': ['sqrt', 'log2', 0.2]}),
+    'knn': (KNeighborsClassifier(), {'n_neighbors': randint(1, 30), 'weights': ['uniform', 'distance']}),
+    'logistic_regression': (LogisticRegression(max_iter=1000), {'C': loguniform(1e-3, 1e2)}),
+}
+
+class ResultCache():
+    """Scores of fitted (configuration, fold, rows) jobs, appended to a JSON lines file."""
+    def __init__(self, path=None):
+        self.path = path
+        self.results = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.results[record['key']] = record['scores']
+
+    def get(self, key):
+        return self.results.get(key)
+
+    def put(self, key, scores):
+        scores = {name: float(value) for name, value in scores.items()}
+        self.results[key] = scores
+        if self.path is not None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'key': key, 'scores': scores}) + '\n')
+
+def job_key(folds, clf, k, n_samples):
+    return f'{folds.key}|{"scaled" if folds.scale else "raw"}|{clf!r}|{k}|{n_samples}'
+
+def rank_score(scores, metric):
+    """Mean test score of a candidate, higher is better, failed or unfinished fits rank last."""
+    values = np.array([np.nan if s is None else s.get(f'test_{metric}', np.nan) for s in scores], dtype=float)
+    if np.isnan(values).any():
+        return -np.inf
+    return -values.mean() if metric.endswith('loss') else values.mean()
+
+def successive_halving(estimator, space, folds, n_candidates=27, factor=3, metric='accuracy_score',
+                       time_budget=None, n_jobs=None, threads_per_job=1, cache=None, random_state=0):
+    """Search the space of one estimator, returns the best configuration and the per-round history.
+
+    Once `time_budget` (seconds) is spent, the running fits are terminated and
+    no new round is started; the best candidate among those that finished all
+    the folds of a round is returned, None if no candidate finished one.
+    """
+    cache = cache or ResultCache()
+    candidates = list(ParameterSampler(space, n_candidates, random_state=random_state))
+    n_train = min(len(train) for train, _ in folds.folds)
+    # One round per division of the candidates by the factor, counted in integers (log(27, 3) is not exactly 3).
+    rounds, n = 1, len(candidates)
+    while n > 1:
+        n = math.ceil(n / factor)
+        rounds += 1
+    deadline = time.perf_counter() + time_budget if time_budget else None
+
+    alive = list(range(len(candidates)))
+    history = []
+    best = None
+    name = type(estimator).__name__
+    for r in range(rounds):
+        # The last round always gets every training row and every fold.
+        fraction = float(factor) ** (r - rounds + 1)
+        n_samples = max(int(n_train * fraction), 2 * len(np.unique(folds.y)))
+        n_folds = min(len(folds), max(2, math.ceil(len(folds) * fraction)))
+
+        scores = {i: [None] * n_folds for i in alive}
+        jobs, owners = [], {}
+        for i in alive:
+            clf = clone(estimator).set_params(**candidates[i])
+            for k in range(n_folds):
+                key = job_key(folds, clf, k, n_samples)
+                scores[i][k] = cache.get(key)
+                if scores[i][k] is None:
+                    jobs.append((f'{name} candidate {i}', clf, k, folds, n_samples))
+                    owners[(i, k)] = key
+
+        for (label, _, k, _, _), result, _ in run_jobs(jobs, cv_metrics, n_jobs, threads_per_job, deadline=deadline):
+            i = int(label.rsplit(' ', 1)[1])
+            # Crashed fits come back empty, they rank last and are not cached.
+            if result:
+                scores[i][k] = result
+                cache.put(owners[(i, k)], result)
+        spent = deadline is not None and time.perf_counter() > deadline
+        if spent:
+            print(f"{name}: time budget spent in round {r}.")
+
+        ranked = sorted(alive, key=lambda i: rank_score(scores[i], metric), reverse=True)
+        if not np.isfinite(rank_score(scores[ranked[0]], metric)):
+            # No candidate finished this round, keep the winner of the previous one.
+            break
+        for i in alive:
+            history.append({'estimator': name, 'round': r, 'candidate': i,
+                            'params': json.dumps(candidates[i], default=str), 'n_samples': n_samples,
+                            'n_folds': n_folds, metric: rank_score(scores[i], metric)})
+        best = ranked[0]
+        alive = ranked[:max(1, math.ceil(len(alive) / factor))]
+        if spent or len(ranked) == 1:
+            break
+
+    if best is None:
+        print(f"{name}: no candidate finished a round.")
+        return None, pd.DataFrame(history)
+    return clone(estimator).set_params(**candidates[best]), pd.DataFrame(history)
+
+def search_classifiers(folds, spaces=None, time_budget=None, cache_path=None, **kwargs):
+    """Run successive halving for every space, the time budget is shared evenly between them.
+
+    Returns the best estimator per space name, leaving out the spaces where no
+    candidate finished within the budget, and the concatenated search history.
+    """
+    spaces = spaces or param_spaces
+    cache = ResultCache(cache_path)
+    best, histories = {}, []
+    for name, (estimator, space) in spaces.items():
+        budget = time_budget / len(spaces) if time_budget else None
+        winner, history = successive_halving(estimator, space, folds, time_budget=budget, cache=cache, **kwargs)
+        histories.append(history.assign(space=name))
+        if winner is not None:
+            best[name] = winner
+            print(f"{name}: {winner}")
+    return best, pd.concat(histories, ignore_index=True)
+
+if __name__ == "__main__":
+    mf = '40X'
+    extractors = ['glcm', 'lbp', 'hog']
+
+    fnames, X, y, spans = read_feature_blocks(extractors, root='features/store/', mf=mf)
+    folds = FoldCache(X, y, PatientKFold(fnames, mf), root=f'classifiers/cache/{mf}/folds/', fnames=fnames)
+    best, history = search_classifiers(folds, time_budget=3600, cache_path=f'classifiers/cache/{mf}/search.jsonl')
+    history.to_csv(f'classifiers/results/binary/{mf}/search_{"".join(extractors)}.csv', index=False)
@@ -0,0 +1,139 @@
+"""Significance of classifier comparisons from their per-fold cross-validation scores.
+
+The fold scores of one cross-validation are not independent, the training
+sets overlap, so a plain paired t-test is too optimistic. The corrected
+resampled t-test of Nadeau and Bengio inflates the variance of the fold
+differences by n_test / n_train to account for it. Confidence intervals of
+the mean score are bootstrapped over the folds, all classifiers and all
+resamples at once as one indexing of the (classifier, fold) score matrix.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+def lower_is_better(metric):
+    return metric.endswith('loss') or metric.endswith('time')
+
+def corrected_ttest(a, b, n_train, n_test):
+    """Corrected resampled t-test of the paired fold scores a and b, returns (t, two-sided p).
+
+    `b` may be a scalar, e.g. the null accuracy, for a one-sample test.
+    Folds where either score is NaN (stopped or failed jobs) are left out.
+    """
+    diff = np.asarray(a, dtype=float) - np.asarray(b, dtype=float)
+    diff = diff[~np.isnan(diff)]
+    k = len(diff)
+    if k < 2:
+        return np.nan, np.nan
+    var = np.var(diff, ddof=1) * (1 / k + n_test / n_train)
+    if var == 0:
+        return (0.0, 1.0) if diff.mean() == 0 else (np.copysign(np.inf, diff.mean()), 0.0)
+    t = diff.mean() / np.sqrt(var)
+    return t, 2 * stats.t.sf(abs(t), k - 1)
+
+def bootstrap_ci(scores, n_resamples=10000, alpha=0.05, random_state=0):
+    """Percentile bootstrap interval of the mean fold score of every row of `scores`.
+
+    `scores` is (n_classifiers, n_folds). The same fold resamples are used for
+    every row, drawn as one (n_resamples, n_folds) index matrix, so the means
+    are a single (n_classifiers, n_resamples) array. Returns the low and high bounds.
+    """
+    scores = np.atleast_2d(np.asarray(scores, dtype=float))
+    rng = np.random.default_rng(random_state)
+    index = rng.integers(0, scores.shape[1], size=(n_resamples, scores.shape[1]))
+    means = np.nanmean(scores[:, index], axis=-1)
+    low, high = np.nanpercentile(means, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=1)
+    return low, high
+
+def holm(p_values):
+    """Holm-Bonferroni adjusted p-values, NaN stays NaN."""
+    p = np.asarray(p_values, dtype=float)
+    adjusted = np.full_like(p, np.nan)
+    valid = np.nonzero(~np.isnan(p))[0]
+    order = valid[np.argsort(p[valid])]
+    m = len(order)
+    running = 0.0
+    for i, j in enumerate(order):
+        running = max(running, min(1.0, (m - i) * p[j]))
+        adjusted[j] = running
+    return adjusted
+
+def fold_sizes(folds):
+    """Mean number of training and test rows per fold, of a FoldCache or a list of (train, test)."""
+    folds = getattr(folds, 'folds', folds)
+    return np.mean([len(train) for train, _ in folds]), np.mean([len(test) for _, test in folds])
+
+def pairwise_tests(cv_results, metric, n_train, n_test):
+    """Matrix of corrected t-test p-values between every pair of classifiers."""
+    names = list(cv_results)
+    p = pd.DataFrame(np.nan, index=names, columns=names)
+    for i, a in enumerate(names):
+        for b in names[i + 1:]:
+            _, p.loc[a, b] = corrected_ttest(cv_results[a][metric], cv_results[b][metric], n_train, n_test)
+            p.loc[b, a] = p.loc[a, b]
+    return p
+
+def compare(cv_results, n_train, n_test, metric='test_accuracy_score', baseline=None, alpha=0.05,
+            n_resamples=10000, random_state=0):
+    """Ranked comparison table of the classifiers on one metric.
+
+    `cv_results` maps a classifier to its per-fold scores, as returned by
+    sweep(). Every classifier is tested against the best one, and against the
+    `baseline` score (e.g. the null accuracy) if given; p-values are
+    Holm-adjusted over the classifiers. `tied` marks the classifiers whose
+    difference to the best is not significant at `alpha`.
+    """
+    names = list(cv_results)
+    scores = np.array([np.asarray(cv_results[name][metric], dtype=float) for name in names])
+    means = np.nanmean(scores, axis=1)
+    sign = -1 if lower_is_better(metric) else 1
+    best = names[int(np.nanargmax(sign * means))]
+    low, high = bootstrap_ci(scores, n_resamples, alpha, random_state)
+
+    table = pd.DataFrame({'classifier': names, 'mean': means, 'std': np.nanstd(scores, axis=1),
+                          'ci_low': low, 'ci_high': high,
+                          'folds': np.sum(~np.isnan(scores), axis=1)})
+    table['diff_to_best'] = table['mean'] - means[names.index(best)]
+    tests = [corrected_ttest(cv_results[best][metric], cv_results[name][metric], n_train, n_test) for name in names]
+    table['t_to_best'] = [t for t, _ in tests]
+    table['p_to_best'] = holm([np.nan if name == best else p for name, (_, p) in zip(names, tests)])
+    table['tied'] = [name == best or not p < alpha for name, p in zip(names, table['p_to_best'])]
+    if baseline is not None:
+        tests = [corrected_ttest(cv_results[name][metric], baseline, n_train, n_test) for name in names]
+        table['p_to_baseline'] = holm([p for _, p in tests])
+        table['beats_baseline'] = [sign * t > 0 and p < alpha for (t, _), p in zip(tests, table['p_to_baseline'])]
+
+    table = table.sort_values('mean', ascending=sign < 0, na_position='last').reset_index(drop=True)
+    table.insert(0, 'rank', np.arange(1, len(table) + 1))
+    return table
+
+def read_fold_scores(path, key=None):
+    """Per-fold scores of a sweep checkpoint, as sweep() returns them, for the folds `key` (the last one by default)."""
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    key = key or records[-1]['folds']
+    records = [record for record in records if record['folds'] == key]
+    n_folds = max(record['fold'] for record in records) + 1
+    results = {}
+    for record in records:
+        scores = results.setdefault(record['classifier'], {})
+        for name, value in record['scores'].items():
+            scores.setdefault(name, np.full(n_folds, np.nan))[record['fold']] = value
+    return results
+
+if __name__ == "__main__":
+    mf = '100X'
+    extractors = ['glcm', 'hos', 'lbp', 'lpq', 'orb', 'wpd', 'hog', 'resnet18', 'googlenet']
+
+    cv_results = read_fold_scores(f'classifiers/cache/{mf}/{"".join(extractors)}_checkpoint.jsonl')
+    saved = np.load(f'classifiers/cache/{mf}/folds/folds.npz')
+    n_folds = len([name for name in saved.files if name.startswith('test_')])
+    n_train, n_test = fold_sizes([(saved[f'train_{k}'], saved[f'test_{k}']) for k in range(n_folds)])
+    null_acc = np.max(np.bincount(saved['y'].astype(int))) / len(saved['y'])
+
+    table = compare(cv_results, n_train, n_test, metric='test_accuracy_score', baseline=null_acc)
+    print(table.to_string())
+    os.makedirs(f'classifiers/results/binary/{mf}/', exist_ok=True)
+    table.to_csv(f'classifiers/results/binary/{mf}/significance_{"".join(extractors)}.csv', index=False)
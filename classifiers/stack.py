@@ -1,10 +1,21 @@
 import numpy as np
 from sklearn.model_selection import train_test_split
+from sklearn.base import clone
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.linear_model import LogisticRegression
+from sklearn.ensemble import ExtraTreesClassifier
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.metrics import accuracy_score, roc_auc_score
 
 import sys
 import os
+import pickle
+import hashlib
 from tqdm import tqdm
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from threadpoolctl import threadpool_limits
 
 # Get the parent directory path
 parent_dir = os.path.abspath(os.path.join(os.getcwd(), "."))
@@ -13,6 +24,8 @@ sys.path.append(parent_dir)
 # print(sys.path)
 # Now we can import the tools module
 from tools import read_images, binary_paths, multiclass_paths
+from features.feature_store import FeatureStore
+from splits import load_splits, train_test_indices
 
 def np_one_hot_encoder(y):
     """Convert labels to one hot vectors."""
@@ -37,6 +50,191 @@ def read_features(extractors, root='./features/all/', mf='40X'):
     return csv['image'], np.transpose(np.array(X, dtype=np.float32)), csv['label']
 
 
+def read_feature_blocks(extractors, root='features/store/', mf='40X', fnames=None, columns=None, mmap_path=None,
+                        selection=None):
+    """Read feature blocks from the binary feature store straight into one float32 matrix.
+
+    Rows are aligned by fname: the given `fnames`, or else the fnames present in
+    every block, in the order of the first one. `columns` maps an extractor to
+    the column indices to keep, and `selection` names a selection saved by
+    features/feature_selection.py to apply to every block that has one. With
+    `mmap_path`, the matrix is a memory-mapped .npy file instead of an in-memory array.
+    Returns fnames, X, y and the (start, end) column span of every block.
+    """
+    store = FeatureStore(os.path.join(root, mf))
+    columns = dict(columns or {})
+    extractors = [str(extractor) for extractor in extractors]
+    if selection is not None:
+        for extractor in extractors:
+            selected = store.selection(extractor, selection)
+            if extractor not in columns and selected is not None:
+                columns[extractor] = selected
+
+    if fnames is None:
+        fnames = store.index(extractors[0])['fname']
+        for extractor in extractors[1:]:
+            fnames = fnames[fnames.isin(store.index(extractor)['fname'])]
+    fnames = np.asarray(fnames)
+
+    widths = [len(np.arange(store.num_features(e))[columns.get(e, slice(None))]) for e in extractors]
+    shape = (len(fnames), sum(widths))
+    if mmap_path:
+        X = np.lib.format.open_memmap(mmap_path, mode='w+', dtype=np.float32, shape=shape)
+    else:
+        X = np.empty(shape, dtype=np.float32)
+
+    spans = {}
+    start = 0
+    for extractor, width in zip(extractors, widths):
+        store.read(extractor, fnames, columns.get(extractor), out=X[:, start:start + width])
+        spans[extractor] = (start, start + width)
+        start += width
+
+    y = store.index(extractors[0]).set_index('fname').loc[fnames, 'label'].to_numpy()
+    return fnames, X, y, spans
+
+base_models = {
+    'lr': LogisticRegression(max_iter=1000),
+    'et': ExtraTreesClassifier(criterion='entropy', n_estimators=200, random_state=0),
+    'knn': KNeighborsClassifier(5),
+}
+
+def class_scores(model, X):
+    """Probabilities (only the positive class for binary problems), else decision values, else labels."""
+    if hasattr(model, 'predict_proba'):
+        scores = model.predict_proba(X)
+        return scores[:, 1:] if scores.shape[1] == 2 else scores
+    if hasattr(model, 'decision_function'):
+        scores = model.decision_function(X)
+        return scores[:, None] if scores.ndim == 1 else scores
+    return model.predict(X)[:, None].astype(np.float64)
+
+def fit_base_model(root, extractor, model, fnames, y, folds, threads=1):
+    """Out-of-fold scores of one base model on one block, and the model refitted on all rows."""
+    with threadpool_limits(limits=threads):
+        X = FeatureStore(root).read(extractor, fnames)
+        oof = None
+        for k in np.unique(folds):
+            test = folds == k
+            fitted = make_pipeline(StandardScaler(), clone(model)).fit(X[~test], y[~test])
+            scores = class_scores(fitted, X[test])
+            if oof is None:
+                oof = np.empty((len(X), scores.shape[1]))
+            oof[test] = scores
+        full = make_pipeline(StandardScaler(), clone(model)).fit(X, y)
+    return oof, full
+
+class StackedGeneralization():
+    """Stacked generalization over extractor blocks of the feature store.
+
+    Level 0 fits every base model on every extractor block separately and
+    keeps its out-of-fold class scores; level 1 fits a meta-learner on the
+    out-of-fold scores of all (extractor, base model) pairs side by side.
+    The folds are the patient-grouped folds of the magnification (splits.py), and
+    every out-of-fold matrix is cached in `cache_dir/<extractor>/<model>.npz`
+    under a hash of the block parameters, the model and the folds, so adding
+    an extractor only trains the base models of the new block.
+    """
+    def __init__(self, extractors, base_models=base_models, meta_model=None, root='features/store/', mf='40X',
+                 cache_dir='classifiers/cache/40X/stacking/', n_splits=10, n_jobs=None, random_state=0):
+        self.extractors = [str(extractor) for extractor in extractors]
+        self.base_models = base_models
+        self.meta_model = meta_model or LogisticRegression(max_iter=1000)
+        self.store = FeatureStore(os.path.join(root, mf))
+        self.mf = mf
+        self.cache_dir = cache_dir
+        self.n_splits = n_splits
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def rows(self):
+        """fnames and labels present in every block, in the order of the first one."""
+        index = self.store.index(self.extractors[0])
+        for extractor in self.extractors[1:]:
+            index = index[index['fname'].isin(self.store.index(extractor)['fname'])]
+        return index['fname'].to_numpy(), index['label'].to_numpy()
+
+    def folds(self, fnames, y):
+        """Fold of every fname, from the patient-grouped splits shared with the other training paths."""
+        return load_splits(fnames, y, self.mf, self.n_splits, random_state=self.random_state)
+
+    def cache_key(self, extractor, model, fnames, folds):
+        digest = hashlib.sha1()
+        digest.update(f'{self.store.params(extractor)}|{model!r}'.encode())
+        digest.update('\n'.join(fnames).encode())
+        digest.update(folds.tobytes())
+        return digest.hexdigest()[:12]
+
+    def cache_path(self, extractor, name, suffix):
+        return os.path.join(self.cache_dir, extractor, f'{name}{suffix}')
+
+    def cached(self, extractor, name, key):
+        path = self.cache_path(extractor, name, '.npz')
+        if not os.path.exists(path):
+            return None
+        cached = np.load(path)
+        return cached['oof'] if str(cached['key']) == key else None
+
+    def fit(self):
+        """Train the missing base models in parallel, then the meta-learner on all out-of-fold scores."""
+        self.fnames, self.y = self.rows()
+        self.fold_ids = self.folds(self.fnames, self.y)
+
+        self.oof = {}
+        todo = {}
+        for extractor in self.extractors:
+            for name, model in self.base_models.items():
+                key = self.cache_key(extractor, model, self.fnames, self.fold_ids)
+                oof = self.cached(extractor, name, key)
+                if oof is None:
+                    todo[(extractor, name)] = key
+                else:
+                    self.oof[(extractor, name)] = oof
+
+        print(f"{len(self.oof)} base models cached, {len(todo)} to train.")
+        root = self.store.root
+        with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+            futures = {executor.submit(fit_base_model, root, extractor, self.base_models[name], self.fnames,
+                                       self.y, self.fold_ids): (extractor, name) for extractor, name in todo}
+            for future in tqdm(as_completed(futures), total=len(futures), desc='Base models'):
+                extractor, name = futures[future]
+                oof, full = future.result()
+                os.makedirs(os.path.join(self.cache_dir, extractor), exist_ok=True)
+                np.savez(self.cache_path(extractor, name, '.npz'), oof=oof, key=todo[(extractor, name)])
+                with open(self.cache_path(extractor, name, '.pkl'), 'wb') as f:
+                    pickle.dump(full, f)
+                self.oof[(extractor, name)] = oof
+
+        self.meta_model = clone(self.meta_model).fit(self.meta_features(), self.y)
+        return self
+
+    def meta_features(self):
+        """Out-of-fold scores of every (extractor, base model) pair side by side."""
+        return np.hstack([self.oof[(extractor, name)] for extractor in self.extractors for name in self.base_models])
+
+    def predict_proba(self, fnames):
+        """Meta-learner probabilities for stored rows, from the base models refitted on all training rows."""
+        columns = []
+        for extractor in self.extractors:
+            X = self.store.read(extractor, fnames)
+            for name in self.base_models:
+                with open(self.cache_path(extractor, name, '.pkl'), 'rb') as f:
+                    columns.append(class_scores(pickle.load(f), X))
+        return self.meta_model.predict_proba(np.hstack(columns))
+
+    def evaluate(self):
+        """Cross-validated accuracy and ROC AUC of the stack, the meta-learner evaluated on the same folds."""
+        Z = self.meta_features()
+        results = []
+        for k in np.unique(self.fold_ids):
+            test = self.fold_ids == k
+            meta = clone(self.meta_model).fit(Z[~test], self.y[~test])
+            proba = meta.predict_proba(Z[test])
+            results.append({'fold': k, 'accuracy_score': accuracy_score(self.y[test], meta.predict(Z[test])),
+                            'roc_auc_score': roc_auc_score(self.y[test], proba[:, 1]) if proba.shape[1] == 2
+                            else roc_auc_score(self.y[test], proba, multi_class='ovr', average='weighted')})
+        return pd.DataFrame(results)
+
 def read_data(root, mf, mode = 'binary', shuffle= True, imsize=None):
     if mode == 'binary':
         paths = binary_paths(root, mf)
@@ -91,10 +289,25 @@ def read_data(root, mf, mode = 'binary', shuffle= True, imsize=None):
 #             X[:, i] = read_features(feature_extractor, imgs)
 #     return X, y
 
-def split_data(X, y, one_hot_vector=False, test_size=0.3):
-    """Return X_train, X_test, y_train, y_test for classifiers with given split rate."""
+def split_data(X, y, one_hot_vector=False, test_size=0.3, fnames=None, mf=None):
+    """Return X_train, X_test, y_train, y_test for classifiers with given split rate.
+
+    With the image `fnames` and magnification `mf`, the split is the patient-grouped one of splits.py.
+    """
+    if fnames is not None and mf is not None:
+        train, test = train_test_indices(fnames, y, mf, test_split=test_size)
+        X, y = np.asarray(X), np.asarray(y)
+        if one_hot_vector:
+            y = np_one_hot_encoder(y)
+        return X[train], X[test], y[train], y[test]
     if one_hot_vector:
         y = np_one_hot_encoder(y)
     # Return X_train, X_test, y_train, y_test.
     return train_test_split(X, y, test_size=test_size, shuffle=True, stratify=y)
 
+
+if __name__ == "__main__":
+    mf = '40X'
+    stack = StackedGeneralization(['glcm', 'lbp', 'hog', 'resnet18'], root='features/store/', mf=mf,
+                                  cache_dir=f'classifiers/cache/{mf}/stacking/').fit()
+    print(stack.evaluate().mean())
@@ -0,0 +1,184 @@
+"""Micro-benchmarks of the feature extractors over the bundled examples/ images.
+
+    python features/benchmark.py run --out bench.json --resolutions 350x228 700x456
+    python features/benchmark.py compare old.json new.json --threshold 0.1
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import platform
+import datetime
+import cv2
+import numpy as np
+
+from extractors.lbp import LocalBinaryPatterns
+from extractors.lpq import LPQ
+from extractors.glcm import GLCM
+from extractors.orb import ORB
+from extractors.pftas import PFTAS
+from extractors.clbp import CLBP
+from extractors.fos import FOS
+from extractors.hog import HOG
+from extractors.hos import HOS
+from extractors.shape import HuMoments
+from extractors.superpixels import SuperpixelsEx
+from extractors.wpd import WPD
+
+examples_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples')
+
+def default_extractors(cnn=False):
+    """Every extractor of features/extractors with the parameters used in feature_extraction.py."""
+    extractors = [LocalBinaryPatterns(8, 1),
+                  LPQ(radius=3, neighbors=8, block_size=3),
+                  GLCM(distances=[1], angles=[0, np.pi/4, np.pi/2, 3*np.pi/4], levels=256),
+                  ORB(num_keypoints=500),
+                  PFTAS(),
+                  CLBP(radius=5, neighbors=24),
+                  FOS(),
+                  HOG(),
+                  HOS(),
+                  HuMoments(),
+                  SuperpixelsEx(),
+                  WPD()]
+    if cnn:
+        # Needs the torchvision weights, downloaded on first use.
+        from extractors.cnn import ResNet18, GoogleNet
+        extractors += [ResNet18(), GoogleNet()]
+    return extractors
+
+def load_examples(resolution):
+    """The example images resized to (height, width)."""
+    paths = sorted(glob.glob(os.path.join(examples_dir, '*.png')))
+    return [cv2.resize(cv2.imread(path), (resolution[1], resolution[0])) for path in paths]
+
+def time_single(extractor, images, repeats):
+    """Latency of every describe call, after one warm-up call."""
+    extractor.describe(images[0])
+    latencies = []
+    for _ in range(repeats):
+        for img in images:
+            start = time.perf_counter()
+            extractor.describe(img)
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+def time_batch(extractor, images, repeats):
+    """Seconds per image of describe_batch, None for extractors without a batched path."""
+    if not hasattr(extractor, 'describe_batch'):
+        return None
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        extractor.describe_batch(images)
+        seconds.append((time.perf_counter() - start) / len(images))
+    return float(np.median(seconds))
+
+def run(extractors, resolutions, repeats=3):
+    """Benchmark every extractor at every resolution.
+
+    An extractor that raises (missing weights, out of memory at a large size...)
+    gets a row with the error instead of the timings, and the run goes on.
+    """
+    results = []
+    for resolution in resolutions:
+        name = f'{resolution[0]}x{resolution[1]}'
+        try:
+            images = load_examples(resolution)
+        except Exception as e:
+            images, error = None, f'{type(e).__name__}: {e}'
+        for extractor in extractors:
+            try:
+                if images is None:
+                    raise RuntimeError(error)
+                latencies = time_single(extractor, images, repeats)
+                batch = time_batch(extractor, images, repeats)
+            except Exception as e:
+                results.append({'extractor': str(extractor), 'resolution': name, 'error': f'{type(e).__name__}: {e}'})
+                print(f"{str(extractor):>12} {name:>9}  failed: {results[-1]['error']}")
+                continue
+            result = {'extractor': str(extractor), 'resolution': name,
+                      'images': len(images), 'repeats': repeats,
+                      'p50': float(np.percentile(latencies, 50)),
+                      'p90': float(np.percentile(latencies, 90)),
+                      'p99': float(np.percentile(latencies, 99)),
+                      'mean': float(latencies.mean()),
+                      'throughput': float(len(latencies) / latencies.sum()),
+                      'batch_latency': batch,
+                      'batch_speedup': float(np.median(latencies) / batch) if batch else None}
+            results.append(result)
+            print(f"{result['extractor']:>12} {result['resolution']:>9}  p50 {result['p50']*1000:9.2f} ms"
+                  f"  p99 {result['p99']*1000:9.2f} ms  {result['throughput']:8.2f} img/s"
+                  + (f"  batch x{result['batch_speedup']:.2f}" if batch else ''))
+    return results
+
+def save(results, path):
+    meta = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count()}
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+def compare(old_path, new_path, threshold=0.1, metric='p50'):
+    """Flag (extractor, resolution) pairs whose latency grew by more than `threshold` (relative).
+
+    Pairs that failed in either run are listed but not compared, a pair that ran
+    in the old results and fails in the new ones is a regression (ratio inf).
+    """
+    with open(old_path) as f:
+        old = {(r['extractor'], r['resolution']): r for r in json.load(f)['results']}
+    with open(new_path) as f:
+        new = {(r['extractor'], r['resolution']): r for r in json.load(f)['results']}
+    slowdowns = []
+    for key in sorted(old.keys() & new.keys()):
+        if 'error' in old[key] or 'error' in new[key]:
+            broke = 'error' not in old[key]
+            print(f"{key[0]:>12} {key[1]:>9}  failed: {new[key].get('error') or old[key].get('error')}"
+                  f"{'  FAILED' if broke else ''}")
+            if broke:
+                slowdowns.append({'extractor': key[0], 'resolution': key[1], 'ratio': float('inf')})
+            del old[key], new[key]
+
+    for key in sorted(old.keys() & new.keys()):
+        ratio = new[key][metric] / old[key][metric]
+        flag = ratio > 1 + threshold
+        print(f"{key[0]:>12} {key[1]:>9}  {old[key][metric]*1000:9.2f} -> {new[key][metric]*1000:9.2f} ms"
+              f"  x{ratio:.2f}{'  SLOWER' if flag else ''}")
+        if flag:
+            slowdowns.append({'extractor': key[0], 'resolution': key[1], 'ratio': ratio})
+    for key in sorted(old.keys() ^ new.keys()):
+        print(f"{key[0]:>12} {key[1]:>9}  only in {'old' if key in old else 'new'} results")
+    return slowdowns
+
+def parse_resolution(value):
+    height, width = value.lower().split('x')
+    return int(height), int(width)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the feature extractors on the examples/ images.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('--out', default='bench.json')
+    run_parser.add_argument('--resolutions', nargs='+', type=parse_resolution, default=[(350, 228), (700, 456)],
+                            help="HEIGHTxWIDTH, tools.read_images resizes to 700x456 "
+                                 "(cv2.resize(img, (456, 700)) takes the width first).")
+    run_parser.add_argument('--repeats', type=int, default=3)
+    run_parser.add_argument('--extractors', nargs='+', default=None, help="Names to run, all by default.")
+    run_parser.add_argument('--cnn', action='store_true', help="Also run the CNN extractors.")
+
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+    compare_parser.add_argument('--metric', default='p50', choices=['p50', 'p90', 'p99', 'mean'])
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        extractors = [e for e in default_extractors(args.cnn) if args.extractors is None or str(e) in args.extractors]
+        save(run(extractors, args.resolutions, args.repeats), args.out)
+    else:
+        # A non-zero exit code lets scripts fail on regressions.
+        sys.exit(1 if compare(args.old, args.new, args.threshold, args.metric) else 0)
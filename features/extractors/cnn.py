@@ -1,6 +1,10 @@
 import os
+import copy
+import hashlib
+import warnings
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torchvision import transforms
 from PIL import Image
 import matplotlib.pyplot as plt
@@ -8,6 +12,9 @@ import torchvision.models as models
 import cv2 as cv
 from torchvision.models.feature_extraction import create_feature_extractor
 from torchvision.models.feature_extraction import get_graph_node_names
+from torch.fx.experimental.optimization import fuse
+from torch.ao.quantization import quantize_dynamic
+from torch.utils.data import Dataset, DataLoader
 import pandas as pd
 import numpy as np
 
@@ -25,7 +32,154 @@ def read_means_and_stds(mf):
 
     return np.array(info_means.loc[mf, :]), np.array(info_stdes.loc[mf, :])
 
-class ResNet18():
+def load_image(img):
+    """Accept an image path or an array and return an RGB Pillow image."""
+    if isinstance(img, (str, os.PathLike)):
+        return Image.open(img).convert('RGB')
+    return Image.fromarray(img).convert('RGB')
+
+# Accepted relative feature drift of the optimized inference paths.
+parity_tolerance = {'float32': 1e-4, 'bfloat16': 5e-2, 'int8': 5e-2}
+
+class ImageDataset(Dataset):
+    """Decodes and transforms images inside DataLoader workers."""
+    def __init__(self, images, transform):
+        self.images = images
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return self.transform(load_image(self.images[index]))
+
+class CNNExtractor():
+    """Base of the CNN extractors, the truncated backbone and the transform are built only once.
+
+    Subclasses set `self.layer` and `self.transform` and then call `self.build()`.
+    """
+    # Whether describe() flattens the feature maps of an image into a vector.
+    flatten = False
+    # Inference settings, changed by optimize().
+    dtype = 'float32'
+    channels_last = False
+
+    def build(self):
+        self.model = nn.Sequential(*self.layer)
+        self.model.eval()
+
+    def forward(self, batch):
+        return self.model(batch)
+
+    def run(self, batch):
+        """Forward a batch with the memory format and autocast settings of the current inference path."""
+        if self.channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=(self.dtype == 'bfloat16')):
+            return self.forward(batch)
+
+    def frozen_path(self, cache_path, dtype):
+        """`cache_path` tagged with the dtype and a hash of the extractor, its layers and its weights,
+        so a module frozen for one configuration is never loaded for another."""
+        digest = hashlib.sha1(f'{self}|{self.model}'.encode())
+        for name, tensor in self.model.state_dict().items():
+            digest.update(name.encode())
+            tensor = tensor.detach().cpu()
+            # numpy has no bfloat16, half-precision weights are hashed as float32.
+            digest.update((tensor.float() if tensor.is_floating_point() else tensor).contiguous().numpy().tobytes())
+        digest = digest.hexdigest()[:12]
+        root, ext = os.path.splitext(cache_path)
+        return f'{root}_{dtype}_{digest}{ext or ".pt"}'
+
+    def optimize(self, dtype='float32', cache_path=None, check_images=None, tolerance=None):
+        """Switch to the CPU inference path: fused conv-bn, channels_last and a frozen TorchScript module.
+
+        dtype='bfloat16' runs the module under CPU autocast, dtype='int8' dynamically quantizes its
+        Linear layers; on a backbone without Linear layers int8 would change nothing, so it warns and
+        falls back to float32 with the float32 tolerance. The traced module is saved to / loaded from
+        `cache_path`, tagged with the dtype and the layer configuration (see frozen_path). With
+        `check_images`, the features are compared against the eager path and a ValueError is raised
+        when the relative drift exceeds `tolerance`.
+        """
+        if dtype == 'int8' and not any(isinstance(m, (nn.Linear, nn.LSTM)) for m in self.model.modules()):
+            warnings.warn(f"{self} has no Linear or LSTM layers, dynamic int8 quantization has no effect; "
+                          f"using float32.")
+            dtype = 'float32'
+
+        eager = CNNExtractor.__new__(type(self))
+        eager.__dict__.update(self.__dict__)
+
+        example = self.transform(load_image(check_images[0])).unsqueeze(0) if check_images is not None else torch.rand(1, 3, 224, 224)
+
+        cache_path = self.frozen_path(cache_path, dtype) if cache_path else None
+        if cache_path and os.path.exists(cache_path):
+            model = torch.jit.load(cache_path)
+        else:
+            model = fuse(copy.deepcopy(self.model).eval(), inplace=True)
+            model = model.to(memory_format=torch.channels_last)
+            if dtype == 'int8':
+                model = quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+            with torch.no_grad():
+                model = torch.jit.freeze(torch.jit.trace(model, example.contiguous(memory_format=torch.channels_last), strict=False))
+            if cache_path:
+                os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+                torch.jit.save(model, cache_path)
+
+        self.model = model
+        self.dtype = dtype
+        self.channels_last = True
+
+        if check_images is None:
+            return None
+        drift = self.parity(eager, check_images)
+        if drift > (tolerance or parity_tolerance[dtype]):
+            raise ValueError(f"{self} features drift by {drift:.2e} from the eager path with dtype={dtype}.")
+        return drift
+
+    def parity(self, other, images):
+        """Largest relative L2 difference between the features of two extractors over the images."""
+        mine = self.describe_batch(images, num_workers=0)
+        theirs = other.describe_batch(images, num_workers=0)
+        return float(np.max(np.linalg.norm(mine - theirs, axis=1) / (np.linalg.norm(theirs, axis=1) + 1e-12)))
+
+    def describe(self, img):
+        image = self.transform(load_image(img))
+        image = image.unsqueeze(0)  # Add batch dimension
+
+        with torch.inference_mode():
+            features = self.run(image)
+
+        if self.flatten:
+            return torch.flatten(features.squeeze())
+        return features.squeeze()
+
+    def describe_batch(self, images, batch_size=32, num_workers=2, device='cpu'):
+        """Run images (paths or arrays) through the backbone in batches, returns an N x D float32 matrix."""
+        loader = DataLoader(ImageDataset(images, self.transform), batch_size=batch_size,
+                            num_workers=num_workers, pin_memory=(device != 'cpu'))
+        self.model.to(device)
+
+        features = np.empty((len(images), 0), dtype=np.float32)
+        start = 0
+        with torch.inference_mode():
+            for batch in loader:
+                output = torch.flatten(self.run(batch.to(device)), start_dim=1)
+                if features.shape[1] == 0:
+                    features = np.empty((len(images), output.shape[1]), dtype=np.float32)
+                features[start:start + len(output)] = output.float().cpu().numpy()
+                start += len(output)
+        return features
+
+def imagenet_transform():
+    return transforms.Compose([
+            transforms.Resize(256),
+            transforms.CenterCrop(224),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
+
+class ResNet18(CNNExtractor):
+    flatten = True
+
     def __init__(self, num_classes = 2, weights='ImageNet', mf='40X'):
         
         self.weights = weights
@@ -39,99 +193,51 @@ class ResNet18():
             pretrained_model.load_state_dict(torch.load(weights, weights_only=True))
         self.layer = list(pretrained_model.children())[:-3]
 
-    def __str__(self):
-        return 'resnet18'
-    
-    def describe(self, img):
-        # Requires image to be Pillow.
-        # Load the image and apply the necessary transformations
-        image = Image.fromarray(img).convert('RGB')
-
         if self.weights:
              mean_per_ch, std_per_ch = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
         else:
              mean_per_ch, std_per_ch = read_means_and_stds(self.mf)
-        transform = transforms.Compose([
+        self.transform = transforms.Compose([
             transforms.Resize(256),
             transforms.CenterCrop(224),
             transforms.ToTensor(),
             transforms.Normalize(mean=mean_per_ch, std=std_per_ch)
             ])
-        image = transform(image)
-        image = image.unsqueeze(0)  # Add batch dimension
-
-        model = nn.Sequential(*self.layer)
-        model.eval()
-        with torch.no_grad():
-                features = model(image)
+        self.build()
 
-        feature_vector = torch.flatten(features.squeeze())
-        return feature_vector
+    def __str__(self):
+        return 'resnet18'
 
-class AlexNet():
+class AlexNet(CNNExtractor):
     def __init__(self, weights='ImageNet'):
         
         if weights == 'ImageNet':
             pretrained_model = models.resnet18(pretrained=True)
 
         self.layer = list(pretrained_model.children())[:-3]
+        self.transform = imagenet_transform()
+        self.build()
         
     def __str__(self):
         return 'alexnet'
-    
-    def describe(self, image_path):
-        # Requires image to be Pillow.
-
-        # Load the image and apply the necessary transformations
-        image = Image.open(image_path).convert('RGB')
-        transform = transforms.Compose([
-                transforms.RandomResizedCrop(224),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
-        image = transform(image)
-        image = image.unsqueeze(0)  # Add batch dimension
 
-        model = nn.Sequential(*self.layer)
-        model.eval()
-        with torch.no_grad():
-                features = model(image)
-
-        return features.squeeze()
-
-class DenseNet161():
+class DenseNet161(CNNExtractor):
     def __init__(self, weights='ImageNet', last_layer_ind=-5):
         
         if weights == 'ImageNet':
             pretrained_model = models.densenet161(pretrained=True)
         self.block = list(pretrained_model.children())[0]
         self.layer = self.block[0:last_layer_ind]
+        self.transform = imagenet_transform()
+        self.build()
         
     def __str__(self):
         return 'densenet161'
-    
-    def describe(self, image_path):
-        # Requires image to be Pillow.
-
-        # Load the image and apply the necessary transformations
-        image = Image.open(image_path).convert('RGB')
-        transform = transforms.Compose([
-                transforms.Resize(256),
-                transforms.CenterCrop(224),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
-        image = transform(image)
-        image = image.unsqueeze(0)  # Add batch dimension
-
-        model = nn.Sequential(*self.layer)
-        model.eval()
-        with torch.no_grad():
-                features = model(image)
 
-        return features.squeeze()
 
+class GoogleNet(CNNExtractor):
+    flatten = True
 
-class GoogleNet():
     def __init__(self, num_classes=2, weights='ImageNet', mf='40X'):
         
         self.weights = weights
@@ -145,35 +251,22 @@ class GoogleNet():
             pretrained_model.load_state_dict(torch.load(weights, weights_only=True))
 
         self.layer = list(pretrained_model.children())[:-3]
-        
-    def __str__(self):
-        return 'googlenet'
-    
-    def describe(self, img):
-        # Requires image to be Pillow.
+
         if self.weights:
              mean_per_ch, std_per_ch = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
         else:
              mean_per_ch, std_per_ch = read_means_and_stds(self.mf)
-        # Load the image and apply the necessary transformations
-        image = Image.fromarray(img).convert('RGB')
-        transform = transforms.Compose([
+        self.transform = transforms.Compose([
                 transforms.Resize(256),
                 transforms.CenterCrop(224),
                 transforms.ToTensor(),
                 transforms.Normalize(mean=mean_per_ch, std=std_per_ch)])
-        image = transform(image)
-        image = image.unsqueeze(0)  # Add batch dimension
-
-        model = nn.Sequential(*self.layer)
-        model.eval()
-        with torch.no_grad():
-                features = model(image)
-
-        feature_vector = torch.flatten(features.squeeze())
-        return feature_vector
+        self.build()
+        
+    def __str__(self):
+        return 'googlenet'
 
-class Inception_V3():
+class Inception_V3(CNNExtractor):
     def __init__(self, weights='ImageNet'):
         
         if weights == 'ImageNet':
@@ -192,217 +285,178 @@ class Inception_V3():
         # self.layer = list(list(pretrained_model.children())[:-4])
          #self.layer = self.block[0:last_layer_ind]
         self.layer = create_feature_extractor(pretrained_model, return_nodes=return_nodes)
-       
-        
-    def __str__(self):
-        return 'inception_v3'
-    
-    def describe(self, image_path):
-        # Requires image to be Pillow.
-
-        # Load the image and apply the necessary transformations
-        image = Image.open(image_path).convert('RGB')
-        transform = transforms.Compose([
+        self.transform = transforms.Compose([
                 transforms.Resize(299),
                 transforms.CenterCrop(299),
                 transforms.ToTensor(),
                 transforms.Normalize([0.485, 0.456, 0.406],
                 [0.229, 0.224, 0.225])])
-        image = transform(image)
-        image = image.unsqueeze(0)  # Add batch dimension
-        model = self.layer
-        model.eval()
-        with torch.no_grad():
-                features = model(image)
-                myFeatures = features['Last Layer']
-        print(myFeatures)
-        return myFeatures.squeeze()
-
-class ShuffleNet_v2_x1_0():
+        self.build()
+
+    def build(self):
+        self.model = self.layer
+        self.model.eval()
+
+    def forward(self, batch):
+        return self.model(batch)['Last Layer']
+        
+    def __str__(self):
+        return 'inception_v3'
+
+class ShuffleNet_v2_x1_0(CNNExtractor):
     def __init__(self, weights='ImageNet', last_layer_ind=-8):
         
         if weights == 'ImageNet':
             pretrained_model = models.shufflenet_v2_x1_0(pretrained=True)
         self.block = list(pretrained_model.children())[0]
         self.layer = self.block[0:last_layer_ind]
+        self.transform = imagenet_transform()
+        self.build()
         
     def __str__(self):
         return 'shufflenet_v2_x1_0'
-    
-    def describe(self, image_path):
-        # Requires image to be Pillow.
-
-        # Load the image and apply the necessary transformations
-        image = Image.open(image_path).convert('RGB')
-        transform = transforms.Compose([
-                transforms.Resize(256),
-                transforms.CenterCrop(224),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
-        image = transform(image)
-        image = image.unsqueeze(0)  # Add batch dimension
 
-        model = nn.Sequential(*self.layer)
-        model.eval()
-        with torch.no_grad():
-                features = model(image)
-
-        return features.squeeze()
-
-class SqueezeNet1_0():
+class SqueezeNet1_0(CNNExtractor):
     def __init__(self, weights='ImageNet', last_layer_ind=-3):
         
         if weights == 'ImageNet':
             pretrained_model = models.squeezenet1_0(pretrained=True)
         self.block = list(pretrained_model.children())[0]
         self.layer = self.block[0:last_layer_ind]
+        self.transform = imagenet_transform()
+        self.build()
         
     def __str__(self):
         return 'squeezenet1_0'
-    
-    def describe(self, image_path):
-        # Requires image to be Pillow.
-
-        # Load the image and apply the necessary transformations
-        image = Image.open(image_path).convert('RGB')
-        transform = transforms.Compose([
-                transforms.Resize(256),
-                transforms.CenterCrop(224),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
-        image = transform(image)
-        image = image.unsqueeze(0)  # Add batch dimension
 
-        model = nn.Sequential(*self.layer)
-        model.eval()
-        with torch.no_grad():
-                features = model(image)
-
-        return features.squeeze()
-
-class Vgg16_Bn():
+class Vgg16_Bn(CNNExtractor):
     def __init__(self, weights='ImageNet', last_layer_ind=-6):
         
         if weights == 'ImageNet':
             pretrained_model = models.vgg16_bn(pretrained=True)
         self.block = list(pretrained_model.children())[0]
         self.layer = self.block[0:last_layer_ind]
+        self.transform = imagenet_transform()
+        self.build()
         
     def __str__(self):
         return 'vgg16_bn'
-    
-    def describe(self, image_path):
-        # Requires image to be Pillow.
-
-        # Load the image and apply the necessary transformations
-        image = Image.open(image_path).convert('RGB')
-        transform = transforms.Compose([
-                transforms.RandomResizedCrop(224),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
-        image = transform(image)
-        image = image.unsqueeze(0)  # Add batch dimension
-
-        model = nn.Sequential(*self.layer)
-        model.eval()
-        with torch.no_grad():
-                features = model(image)
-
-        return features.squeeze()
 
-class Vgg16():
+class Vgg16(CNNExtractor):
     def __init__(self, weights='ImageNet', last_layer_ind=-9):
         
         if weights == 'ImageNet':
             pretrained_model = models.vgg16(pretrained=True)
         self.block = list(pretrained_model.children())[0]
         self.layer = self.block[0:last_layer_ind]
+        self.transform = imagenet_transform()
+        self.build()
         
     def __str__(self):
         return 'vgg16'
-    
-    def describe(self, image_path):
-        # Requires image to be Pillow.
-
-        # Load the image and apply the necessary transformations
-        image = Image.open(image_path).convert('RGB')
-        transform = transforms.Compose([
-                transforms.Resize(256),
-                transforms.CenterCrop(224),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
-        image = transform(image)
-        image = image.unsqueeze(0)  # Add batch dimension
 
-        model = nn.Sequential(*self.layer)
-        model.eval()
-        with torch.no_grad():
-                features = model(image)
-
-        return features.squeeze()
-
-class Vgg19_bn():
+class Vgg19_bn(CNNExtractor):
     def __init__(self, weights='ImageNet', last_layer_ind=-3):
         
         if weights == 'ImageNet':
             pretrained_model = models.vgg19_bn(pretrained=True)
         self.block = list(pretrained_model.children())[0]
         self.layer = self.block[0:last_layer_ind]
+        self.transform = imagenet_transform()
+        self.build()
         
     def __str__(self):
         return 'vgg19_bn'
-    
-    def describe(self, image_path):
-        # Requires image to be Pillow.
-
-        # Load the image and apply the necessary transformations
-        image = Image.open(image_path).convert('RGB')
-        transform = transforms.Compose([
-                transforms.Resize(256),
-                transforms.CenterCrop(224),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
-        image = transform(image)
-        image = image.unsqueeze(0)  # Add batch dimension
-
-        model = nn.Sequential(*self.layer)
-        model.eval()
-        with torch.no_grad():
-                features = model(image)
 
-        return features.squeeze()
-
-class Vgg19():
+class Vgg19(CNNExtractor):
     def __init__(self, weights='ImageNet', last_layer_ind=-4):
         
         if weights == 'ImageNet':
             pretrained_model = models.vgg19(pretrained=True)
         self.block = list(pretrained_model.children())[0]
         self.layer = self.block[0:last_layer_ind]
-        
-    def __str__(self):
-        return 'vgg19'
-    
-    def describe(self, image_path):
-        # Requires image to be Pillow.
-
-        # Load the image and apply the necessary transformations
-        image = Image.open(image_path).convert('RGB')
-        transform = transforms.Compose([
+        self.transform = transforms.Compose([
                 transforms.Resize((224, 224)),  # Resize the image to 224x224
                 transforms.ToTensor(),  # Convert the image to a tensor
                 transforms.Normalize( mean=[0.485, 0.456, 0.406],  # Normalize the image channel-wise
                                         std=[0.229, 0.224, 0.225])])
-        image = transform(image)
-        image = image.unsqueeze(0)  # Add batch dimension
+        self.build()
+        
+    def __str__(self):
+        return 'vgg19'
 
-        model = nn.Sequential(*self.layer)
-        model.eval()
-        with torch.no_grad():
-                features = model(image)
 
-        return features.squeeze()
+def gem_pool(x, p=3, eps=1e-6):
+    """Generalized mean pooling, between average (p=1) and max (p -> inf) pooling."""
+    return F.adaptive_avg_pool2d(x.clamp(min=eps).pow(p), 1).pow(1. / p)
+
+pooling_functions = {
+    'avg': lambda x: F.adaptive_avg_pool2d(x, 1),
+    'max': lambda x: F.adaptive_max_pool2d(x, 1),
+    'gem': gem_pool,
+}
+
+class MultiLayer(CNNExtractor):
+    """Globally pooled features of several graph nodes of one backbone, in a single forward pass.
+
+    Node names are the ones listed by get_graph_node_names, e.g. ['layer2', 'layer3', 'layer4'] for ResNets.
+    """
+    flatten = True
+
+    def __init__(self, model='resnet18', return_nodes=('layer2', 'layer3', 'layer4'), pooling='avg', transform=None, name=None):
+
+        if isinstance(model, str):
+            name = name or model
+            model = getattr(models, model)(weights='DEFAULT')
+
+        self.name = name or model.__class__.__name__.lower()
+        self.return_nodes = list(return_nodes)
+        self.pooling = pooling
+        self.pool = pooling_functions[pooling]
+
+        self.layer = create_feature_extractor(model, return_nodes={node: node for node in self.return_nodes})
+        self.transform = transform or imagenet_transform()
+        self.block_sizes = None
+        self.build()
+
+    def build(self):
+        self.model = self.layer
+        self.model.eval()
+
+    def forward(self, batch):
+        outputs = self.model(batch)
+        pooled = [torch.flatten(self.pool(outputs[node]) if outputs[node].dim() == 4 else outputs[node], start_dim=1)
+                  for node in self.return_nodes]
+        self.block_sizes = [p.shape[1] for p in pooled]
+        return torch.cat(pooled, dim=1)
+
+    def block_names(self):
+        return [f'{self.name}_{node}' for node in self.return_nodes]
+
+    def blocks(self):
+        """One LayerBlock per node, the feature store keys of describe_blocks."""
+        return [LayerBlock(self, node) for node in self.return_nodes]
+
+    def describe_blocks(self, images, **kwargs):
+        """Same as describe_batch, but split into one N x D_node matrix per requested node."""
+        features = self.describe_batch(images, **kwargs)
+        splits = np.split(features, np.cumsum(self.block_sizes)[:-1], axis=1)
+        return dict(zip(self.block_names(), splits))
+
+    def __str__(self):
+        return f'{self.name}_multilayer'
+
+class LayerBlock():
+    """The features of one node of a MultiLayer, stored in the feature store as an extractor of its own."""
+    def __init__(self, multilayer, node):
+        self.multilayer = multilayer
+        self.node = node
+
+    def params(self):
+        return {'model': self.multilayer.name, 'node': self.node, 'pooling': self.multilayer.pooling}
+
+    def __str__(self):
+        return f'{self.multilayer.name}_{self.node}'
 
 
 if __name__ == "__main__":
@@ -6,6 +6,13 @@ class ORB:
         self.num_keypoints = num_keypoints
         self.orb = cv2.ORB_create(nfeatures=num_keypoints)
     
+    def __getstate__(self):
+        # cv2 objects can not be pickled, workers rebuild the detector.
+        return {'num_keypoints': self.num_keypoints}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
     def describe(self, image):
         # Detect keypoints and compute their descriptors
         keypoints, descriptors = self.orb.detectAndCompute(image, None)
@@ -1,6 +1,7 @@
 import cv2 as cv
 import numpy as np
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 
 
 str_to_algorithm = {
@@ -9,66 +10,113 @@ str_to_algorithm = {
     'MSLIC': cv.ximgproc.MSLIC
 }
 
+# Columns of the per-segment statistics table.
+segment_columns = ['mean_0', 'mean_1', 'mean_2', 'area', 'compactness', 'texture']
+
+def segment_statistics(img, labels, num_superpixels=None):
+    """Per-superpixel mean color, area, compactness and texture computed in one pass over the label map."""
+    if num_superpixels is None:
+        num_superpixels = int(labels.max()) + 1
+
+    flat = labels.ravel()
+    area = np.bincount(flat, minlength=num_superpixels).astype(np.float64)
+    safe_area = np.maximum(area, 1)
+
+    pixels = img.reshape(-1, img.shape[-1]).astype(np.float64)
+    mean_color = np.stack([np.bincount(flat, weights=pixels[:, c], minlength=num_superpixels)
+                           for c in range(pixels.shape[1])], axis=1) / safe_area[:, None]
+
+    # Texture is the standard deviation of the intensity inside each segment.
+    intensity = pixels.mean(axis=1)
+    first = np.bincount(flat, weights=intensity, minlength=num_superpixels) / safe_area
+    second = np.bincount(flat, weights=intensity ** 2, minlength=num_superpixels) / safe_area
+    texture = np.sqrt(np.maximum(second - first ** 2, 0))
+
+    # Perimeter is the number of pixels touching another segment or the image border.
+    boundary = np.zeros(labels.shape, dtype=bool)
+    boundary[:-1, :] |= labels[:-1, :] != labels[1:, :]
+    boundary[1:, :] |= labels[1:, :] != labels[:-1, :]
+    boundary[:, :-1] |= labels[:, :-1] != labels[:, 1:]
+    boundary[:, 1:] |= labels[:, 1:] != labels[:, :-1]
+    boundary[[0, -1], :] = True
+    boundary[:, [0, -1]] = True
+    perimeter = np.bincount(flat, weights=boundary.ravel(), minlength=num_superpixels)
+    compactness = np.minimum(4 * np.pi * area / np.maximum(perimeter, 1) ** 2, 1)
+
+    return np.column_stack([mean_color[:, :3], area, compactness, texture])
+
 class SuperpixelsEx():
 
-    def __init__(self, algorithm='SLIC'):
-        
+    def __init__(self, algorithm='SLIC', region_size=100, iterations=10):
+
         self.algorithm = str_to_algorithm[algorithm]
+        self.region_size = region_size
+        self.iterations = iterations
 
     def __str__(self):
         return 'superpixels'
 
-    def describeImage(self,img):
-
+    def segment(self, img):
+        """Run SLIC on the blurred image, returns the fitted SLIC object and the blurred image."""
         img = cv.GaussianBlur(img, (3, 3), 0)
         # instance and run SLIC
-        slic = cv.ximgproc.createSuperpixelSLIC(img, self.algorithm, 100)
-        slic.iterate(10)
+        slic = cv.ximgproc.createSuperpixelSLIC(img, self.algorithm, self.region_size)
+        slic.iterate(self.iterations)
+        return slic, img
+
+    def describeImage(self,img):
+
+        slic, img = self.segment(img)
 
         # get and draw superpixels
         mask = slic.getLabelContourMask()
-        
+
         img_superpixeled = img.copy()
         img_superpixeled[mask != 0] = (0, 255, 255)
 
         # replace original image pixels with superpixels means
         labels = slic.getLabels()
+        num_superpixels = slic.getNumberOfSuperpixels()
 
-        img_clustered = np.zeros_like(img)
+        stats = segment_statistics(img, labels, num_superpixels)
+        img_clustered = stats[:, :img.shape[-1]][labels].astype(img.dtype)
 
+        return img_clustered, img_superpixeled, labels, num_superpixels
+
+    def extract_features(self, img):
+        """Summarize the segment statistics of an image as a fixed-length vector."""
+        slic, img = self.segment(img)
+        labels = slic.getLabels()
         num_superpixels = slic.getNumberOfSuperpixels()
-        print(num_superpixels)
-        for k in range(num_superpixels):
-            class_mask = (labels == k).astype("uint8")
-            mean_color = cv.mean(img, class_mask)
-            img_clustered[class_mask != 0, :] = mean_color[:3]
 
-        return img_clustered, img_superpixeled, labels, num_superpixels
+        stats = segment_statistics(img, labels, num_superpixels)
+        # Drop labels that SLIC left empty.
+        stats = stats[stats[:, 3] > 0]
 
+        return np.concatenate([[len(stats)], stats.mean(axis=0), stats.std(axis=0)])
 
-    def extract_features(self, img):
-        pass
+    def describe(self, img):
+        return self.extract_features(img)
+
+    def describe_batch(self, images, n_jobs=None, chunksize=8):
+        """Extract superpixel features for many images on a process pool."""
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            features = list(executor.map(self.extract_features, images, chunksize=chunksize))
+        return np.array(features, dtype=np.float32)
 
 if __name__ == '__main__':
     image = cv.imread('.\examples\SOB_B_A-14-22549AB-40-019.png', cv.IMREAD_COLOR)
     image = cv.cvtColor(image, cv.COLOR_BGR2Lab)
     my_superpixels = SuperpixelsEx()
     img_clustered, img_superpixeled, labels, num_superpixels = my_superpixels.describeImage(image)
-    print(np.unique(labels), num_superpixels) 
+    print(np.unique(labels), num_superpixels)
     plt.imshow(labels)
     plt.show()
     cv.imwrite("C:/Users/hadil/Documents/projects/Machine Learning/project/breast/benign/SOB/adenosis/SOB_B_A_14-22549AB/40X/SOB_B_A-14-22549AB-40-001.png", labels)
-    all_features = []
-    for k in range(num_superpixels):
-        class_mask = (labels == k).astype("uint8")
-        ma_sk = (labels == k).astype(np.uint8)
-        img_clustered = cv.bitwise_and(img_superpixeled, img_superpixeled, mask=ma_sk)
-        features = my_superpixels.extract_features(img_clustered)
-        all_features.append(features)
-
 
-    all_features = np.array(all_features)
+    # Per-superpixel statistics, one row per label.
+    all_features = segment_statistics(image, labels, num_superpixels)
     print(all_features.shape)
 
     #Just for testing:
-    #np.savetxt('all_features.csv', all_features, delimiter=',')
\ No newline at end of file
+    #np.savetxt('all_features.csv', all_features, delimiter=',')
@@ -10,7 +10,10 @@ from extractors.hos import HOS
 from extractors.hog import HOG
 from extractors.superpixels import SuperpixelsEx
 from extractors.wpd import WPD
-from extractors.cnn import GoogleNet, ResNet18
+from extractors.cnn import GoogleNet, ResNet18, CNNExtractor, MultiLayer
+from feature_store import FeatureStore
+from profiling import ExtractorProfiler
+import argparse
 
 #from extractors.lbp import LocalBinaryPatterns
 #from extractors.glcm import GLCM
@@ -35,8 +38,17 @@ import warnings
 from classifiers.stack import read_data
 from torchvision import transforms
 
-def extract_features(stacks, extractors=None, save=True, feature_dir="features/all/binary/40X/"):
-    """Extract features from input images using specified feature extractors."""
+def extract_features(stacks, extractors=None, save=True, feature_dir="features/all/binary/40X/", store=None, chunk_rows=256,
+                     profiler=None):
+    """Extract features from input images using specified feature extractors.
+
+    With a FeatureStore, rows are appended to the store in chunks of `chunk_rows`
+    instead of being written as one CSV per image; CNN extractors also run chunk by
+    chunk, so an interrupted run keeps every stored chunk. An ExtractorProfiler records
+    the cost of every extractor call.
+    """
+    if profiler is None:
+        profiler = ExtractorProfiler()
     # Initialize target matrix.
     y = np.array(stacks)[:, 1]
     # Get images.
@@ -53,8 +65,37 @@ def extract_features(stacks, extractors=None, save=True, feature_dir="features/a
     # df = pd.DataFrame.from_dict(dict_)
 
     for extractor in extractors:
-        for j in tqdm(range(len(imgs))):
-            feature_values = list(extractor.describe(imgs[j]))
+        # Each depth of a MultiLayer is its own block, to be selected and fused separately.
+        if isinstance(extractor, MultiLayer):
+            extract_blocks(extractor, imgs, y, fnames, feature_dir, store, chunk_rows, profiler)
+            continue
+
+        todo = np.arange(len(imgs))
+        # Only compute rows the store does not already hold for these extractor parameters.
+        if store is not None:
+            missing = set(store.missing(extractor, fnames))
+            todo = np.array([j for j in todo if fnames[j] in missing], dtype=int)
+            print(f"{extractor}: {len(imgs) - len(todo)} images up to date, {len(todo)} to extract.")
+
+        rows = []
+        for i, j in enumerate(tqdm(todo)):
+            if isinstance(extractor, CNNExtractor):
+                # CNN backbones run a whole chunk at once, so every chunk is stored before the next one is computed.
+                if i % chunk_rows == 0:
+                    chunk = todo[i:i + chunk_rows]
+                    batch_values = profiler.call(extractor, extractor.describe_batch, imgs[chunk], fnames=list(fnames[chunk]))
+                feature_values = list(batch_values[i % chunk_rows])
+            else:
+                feature_values = list(profiler.describe(extractor, imgs[j], fnames[j]))
+
+            if store is not None:
+                rows.append(np.ravel(feature_values))
+                if len(rows) == chunk_rows or i == len(todo) - 1:
+                    chunk = todo[i + 1 - len(rows):i + 1]
+                    store.append(extractor, fnames[chunk], y[chunk], np.array(rows))
+                    rows = []
+                continue
+
             feature_values.append(y[j]) 
 
             filename = feature_dir + str(extractor) + "/" + f'{fnames[j]}.csv'
@@ -67,6 +108,37 @@ def extract_features(stacks, extractors=None, save=True, feature_dir="features/a
 
     return fnames
 
+def extract_blocks(multilayer, imgs, y, fnames, feature_dir, store=None, chunk_rows=256, profiler=None):
+    """Run a MultiLayer chunk by chunk and store every node as its own extractor (see LayerBlock).
+
+    Without a store, the blocks are written as CSVs by save_feature_blocks.
+    """
+    profiler = profiler or ExtractorProfiler()
+    blocks = multilayer.blocks()
+    todo = np.arange(len(imgs))
+    if store is not None:
+        missing = set().union(*(store.missing(block, fnames) for block in blocks))
+        todo = np.array([j for j in todo if fnames[j] in missing], dtype=int)
+        print(f"{multilayer}: {len(imgs) - len(todo)} images up to date, {len(todo)} to extract.")
+    elif len(todo):
+        values = profiler.call(multilayer, multilayer.describe_blocks, imgs[todo], fnames=list(fnames[todo]))
+        save_feature_blocks(values, fnames[todo], y[todo], feature_dir=feature_dir)
+        return
+
+    for start in tqdm(range(0, len(todo), chunk_rows)):
+        chunk = todo[start:start + chunk_rows]
+        values = profiler.call(multilayer, multilayer.describe_blocks, imgs[chunk], fnames=list(fnames[chunk]))
+        for block in blocks:
+            store.append(block, fnames[chunk], y[chunk], values[str(block)])
+
+def save_feature_blocks(blocks, fnames, y, feature_dir="features/all/40X/stat/"):
+    """Write each feature block as its own image/label/features CSV, readable by read_features."""
+    for key, values in blocks.items():
+        df = pd.DataFrame(values, columns=[f'{key}_{i}' for i in range(values.shape[1])])
+        df.insert(0, 'image', fnames)
+        df.insert(1, 'label', y)
+        df.to_csv(os.path.join(feature_dir, f'{key}.csv'), index=False)
+
 def assign_multiclass_label_to_features():
     # TODO: From fnames, we can assign labels as new column. 
     pass
@@ -95,6 +167,10 @@ def assign_multiclass_label_to_features():
 #      return fnames, features
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract features of the BreaKHis images.")
+    parser.add_argument('--profile', default=None,
+                        help="Write a per-extractor cost report to this .csv or .json file.")
+    args = parser.parse_args()
     
     mf = '100X'
     extractors = [# LocalBinaryPatterns(8, 1), 
@@ -108,6 +184,8 @@ if __name__ == "__main__":
                   # SuperpixelsEx(),
                   HOG(),
                   # WPD(),
+                  # Several depths of one backbone in a single pass, stored as the blocks resnet18_layer2, _layer3, _layer4.
+                  # MultiLayer('resnet18', return_nodes=['layer2', 'layer3', 'layer4'], pooling='avg'),
                   # ResNet18(num_classes=2, mf=mf, weights="models/results/40X/weights/40X_on-air-aug_std_none_pre-resnet18_sgde-2e-4_bcew_32bs-strf_100ep_2023-06-23.pth"),
                   # GoogleNet(num_classes=2, mf=mf, weights="models/results/40X/weights/40X_on-air-aug_std_none_pre-googlenet_sgde-2e-4_bcew_32bs-strf_100ep_2023-06-23.pth"),
                   ]
@@ -117,6 +195,13 @@ if __name__ == "__main__":
         print("Please change data dir!!")
         raise NotADirectoryError
     
-    fnames, df = extract_features(stack, extractors=extractors, save=True, feature_dir=f'features/all/{mf}/stat/')
+    profiler = ExtractorProfiler()
+    try:
+        fnames = extract_features(stack, extractors=extractors, save=True, feature_dir=f'features/all/{mf}/stat/',
+                                  store=FeatureStore(f'features/store/{mf}/'), profiler=profiler)
+    finally:
+        # A failed or interrupted run still keeps the profile of what it extracted.
+        if args.profile:
+            profiler.save(args.profile)
 
     # fnames, fs = extract_imageLike(stack, extractor=extractors[0], save=True, feature_dir=f'D:/imageLike_features/{mf}/')
\ No newline at end of file
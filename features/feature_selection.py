@@ -1,74 +1,149 @@
-import os
+"""Streaming univariate feature selection over the feature store.
+
+Scores are computed in one pass over row chunks from running per-feature
+sums, so the dense feature matrix is never built. Mutual information takes a
+first pass for the per-feature min and max, so the histogram bins cover the
+whole column and not only the first chunk. The top-k column indices
+are saved next to the extractor in the store and applied lazily when the
+features are read (see classifiers.stack.read_feature_blocks).
+"""
 import numpy as np
 import pandas as pd
-
-key = 'hog'
-mf = '100X'
-folder_path = f'./features/all/{mf}/stat/{key}/'
-
-# Count the number of csv files in the folder
-number_of_images = sum(1 for file_name in os.listdir(folder_path) if file_name.endswith('.csv'))
-
-# Assuming all csv files have the same number of features (columns)
-number_of_features = 1
-
-csv_file_path = os.path.join(folder_path, os.listdir(folder_path)[0])
-number_of_rows = pd.read_csv(csv_file_path).shape[0]
-number_of_features += number_of_rows
-
-feature_matrix = np.zeros((number_of_images, number_of_features))
-image_names = []
-
-for i, file_name in enumerate(os.listdir(folder_path)):
-    if file_name.endswith('.csv'):
-        file_path = os.path.join(folder_path, file_name)
-        image_name = file_name[1:-4]  # Remove the last 4 characters (.csv) from the file name
-        image_names.append(image_name)
-        features = np.loadtxt(file_path, delimiter=',')
-        feature_matrix[i, :] = features
-
-target_var = feature_matrix[:, -1]
-feature_matrix = feature_matrix[:, :-1] 
-
-# Perform feature selection (example using mutual information)
-from sklearn.feature_selection import SelectKBest, f_regression
-
-# Set the desired number of features to keep
-num_features_to_keep = 1000
-
-# Perform feature selection using SelectKBest and f_regression
-selector = SelectKBest(score_func=f_regression, k=num_features_to_keep)
-selected_features = selector.fit_transform(feature_matrix, target_var)
-
-# Get the indices of the selected features
-selected_indices = selector.get_support(indices=True)
-
-# Filter the feature_matrix to keep only the selected features
-selected_feature_matrix = feature_matrix[:, selected_indices]
-
-print(selected_feature_matrix.shape)
-
-# Create a DataFrame with selected features and image names as indices
-selected_df = pd.DataFrame(selected_feature_matrix, index=image_names)
-
-# Create a DataFrame with selected features and image names as columns
-column_headers = [f"{key}" + str(i) for i in range(selected_feature_matrix.shape[1])]
-column_headers = ["image"] + ["label"] + column_headers
-
-# Create a DataFrame with selected features and image names as columns
-selected_df = pd.DataFrame(selected_feature_matrix, columns=column_headers[2:])
-
-# Insert the "image" column at the beginning
-selected_df.insert(0, "image", image_names)
-
-# Insert a placeholder column for the "label" column
-selected_df.insert(1, "label", "")
-
-# Assign the target variable values to the "label" column
-selected_df["label"] = target_var
-
-# Remove the target_var column from the end of the DataFrame
-selected_df = selected_df.iloc[:, :-1]
-
-# Save the DataFrame to a CSV file
-selected_df.to_csv(f'{key}.csv', index=False)
+from feature_store import FeatureStore
+
+score_functions = ['f_regression', 'f_classif', 'mutual_info']
+
+class RunningStats():
+    """Per-feature running sums of a stream of (X, y) chunks.
+
+    Per-class histograms for the mutual information are only counted when the
+    per-feature range (`low`, `high`) of the whole stream is given.
+    """
+    def __init__(self, bins=16, low=None, high=None):
+        self.bins = bins
+        self.n = 0
+        self.classes = {}
+        self.sum_x = self.sum_xx = self.sum_xy = None
+        self.sum_y = self.sum_yy = 0.
+        self.edges = None
+        if low is not None and high is not None:
+            low, high = np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64)
+            self.edges = (low, np.where(high > low, high - low, 1.))
+
+    def update(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if self.sum_x is None:
+            self.sum_x, self.sum_xx, self.sum_xy = (np.zeros(X.shape[1]) for _ in range(3))
+
+        self.n += len(X)
+        self.sum_x += X.sum(axis=0)
+        self.sum_xx += np.einsum('ij,ij->j', X, X)
+        self.sum_xy += y @ X
+        self.sum_y += y.sum()
+        self.sum_yy += y @ y
+
+        if self.edges is not None:
+            # Only the column maximum itself lands on the upper edge, it goes to the last bin.
+            bin_index = np.clip(((X - self.edges[0]) / self.edges[1] * self.bins).astype(int), 0, self.bins - 1)
+        for label in np.unique(y):
+            rows = y == label
+            if label not in self.classes:
+                self.classes[label] = {'n': 0, 'sum': np.zeros(X.shape[1]), 'sum_sq': np.zeros(X.shape[1]),
+                                       'hist': np.zeros((X.shape[1], self.bins))}
+            stats = self.classes[label]
+            stats['n'] += rows.sum()
+            stats['sum'] += X[rows].sum(axis=0)
+            stats['sum_sq'] += np.einsum('ij,ij->j', X[rows], X[rows])
+            if self.edges is None:
+                continue
+            # Per-feature histogram counts via one bincount over (feature, bin) codes.
+            codes = (bin_index[rows] + np.arange(X.shape[1]) * self.bins).ravel()
+            stats['hist'] += np.bincount(codes, minlength=X.shape[1] * self.bins).reshape(X.shape[1], self.bins)
+
+    def f_regression(self):
+        """Same statistic as sklearn.feature_selection.f_regression."""
+        mean_x, mean_y = self.sum_x / self.n, self.sum_y / self.n
+        cov = self.sum_xy - self.n * mean_x * mean_y
+        var_x = self.sum_xx - self.n * mean_x ** 2
+        var_y = self.sum_yy - self.n * mean_y ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = cov / np.sqrt(var_x * var_y)
+            return corr ** 2 / (1 - corr ** 2) * (self.n - 2)
+
+    def f_classif(self):
+        """One-way ANOVA F-value, same as sklearn.feature_selection.f_classif."""
+        mean = self.sum_x / self.n
+        between = sum(c['n'] * (c['sum'] / c['n'] - mean) ** 2 for c in self.classes.values())
+        within = sum(c['sum_sq'] - c['sum'] ** 2 / c['n'] for c in self.classes.values())
+        k = len(self.classes)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (between / (k - 1)) / (within / (self.n - k))
+
+    def mutual_info(self):
+        """Mutual information (nats) between the binned feature and the class."""
+        if self.edges is None:
+            raise ValueError("Mutual information needs the feature ranges, see column_ranges.")
+        joint = np.stack([c['hist'] for c in self.classes.values()], axis=-1) / self.n
+        p_bin = joint.sum(axis=-1, keepdims=True)
+        p_class = joint.sum(axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = joint * np.log(joint / (p_bin * p_class))
+        return np.nansum(terms, axis=(1, 2))
+
+def column_ranges(store, extractor, chunk_rows=1024):
+    """Per-feature min and max of an extractor, streamed over the store."""
+    low = high = None
+    for _, X, _ in store.iter_chunks(extractor, chunk_rows):
+        low = X.min(axis=0) if low is None else np.minimum(low, X.min(axis=0))
+        high = X.max(axis=0) if high is None else np.maximum(high, X.max(axis=0))
+    return low, high
+
+def streaming_scores(store, extractor, score='f_regression', chunk_rows=1024, bins=16):
+    """Univariate scores of every feature of an extractor in one pass over the store,
+    two for the mutual information (see column_ranges)."""
+    low, high = column_ranges(store, extractor, chunk_rows) if score == 'mutual_info' else (None, None)
+    stats = RunningStats(bins=bins, low=low, high=high)
+    for _, X, y in store.iter_chunks(extractor, chunk_rows):
+        stats.update(X, y)
+    return getattr(stats, score)()
+
+def select_k_best(scores, k):
+    """Indices of the k highest scores in increasing column order, NaN scores rank last."""
+    scores = np.nan_to_num(scores, nan=-np.inf)
+    k = min(k, len(scores))
+    return np.sort(np.argpartition(-scores, k - 1)[:k])
+
+def select_features(store, extractor, k=1000, score='f_regression', chunk_rows=1024, name=None):
+    """Score, select and save the top-k features of an extractor, returns the indices."""
+    scores = streaming_scores(store, extractor, score, chunk_rows)
+    indices = select_k_best(scores, k)
+    store.save_selection(extractor, name or f'{score}_{k}', indices, scores)
+    return indices
+
+if __name__ == "__main__":
+    key = 'hog'
+    mf = '100X'
+    folder_path = f'./features/all/{mf}/stat/{key}/'
+
+    # Import the per-image CSVs into the feature store on first use.
+    store = FeatureStore(f'./features/store/{mf}/')
+    if key not in store.extractors():
+        store.import_csv_dir(key, folder_path)
+
+    # Set the desired number of features to keep
+    num_features_to_keep = 1000
+    selected_indices = select_features(store, key, k=num_features_to_keep, score='f_regression')
+
+    # Only the selected columns are read from the store.
+    image_names, selected_feature_matrix, target_var = store.load(key, columns=selected_indices)
+    print(selected_feature_matrix.shape)
+
+    # Create a DataFrame with selected features and image names as columns
+    column_headers = [f"{key}" + str(i) for i in range(selected_feature_matrix.shape[1])]
+    selected_df = pd.DataFrame(selected_feature_matrix, columns=column_headers)
+    selected_df.insert(0, "image", image_names)
+    selected_df.insert(1, "label", target_var)
+
+    # Save the DataFrame to a CSV file
+    selected_df.to_csv(f'{key}.csv', index=False)
@@ -0,0 +1,211 @@
+import os
+import glob
+import json
+import inspect
+import hashlib
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+index_columns = ['fname', 'label', 'shard', 'row', 'params']
+
+def extractor_params(extractor):
+    """Plain parameters of an extractor object, the ones that change its output.
+
+    These are the extractor's own `params()` if it has one, else the attributes
+    named after its constructor arguments. State set after construction (the
+    block sizes found by a first forward, the dtype chosen by optimize...) is
+    left out, so it does not invalidate the stored rows.
+    """
+    if isinstance(extractor, str):
+        return {'name': extractor}
+    params = {'name': str(extractor), 'class': type(extractor).__name__}
+    if callable(getattr(extractor, 'params', None)):
+        params.update(extractor.params())
+        return params
+    arguments = inspect.signature(type(extractor).__init__).parameters
+    for key, value in vars(extractor).items():
+        if key in arguments and isinstance(value, (str, int, float, bool, tuple, list, type(None))):
+            params[key] = value
+    return params
+
+def params_hash(extractor):
+    """Short stable hash of the extractor parameters."""
+    params = json.dumps(extractor_params(extractor), sort_keys=True, default=str)
+    return hashlib.sha1(params.encode()).hexdigest()[:12]
+
+class FeatureStore():
+    """Columnar feature store, replaces the one CSV per image and extractor layout.
+
+    Every extractor gets its own directory under `root` with its rows packed
+    into float32 `.npy` shards, and an `index.csv` mapping each fname to its
+    label, shard and row:
+
+        root/<extractor>/shard_00000.npy    (rows x features)
+        root/<extractor>/index.csv          fname, label, shard, row, params
+        root/<extractor>/meta.json          current parameters and their hash
+
+    Shards are memory-mapped on read, so single rows can be fetched without
+    loading the whole matrix. When a fname is appended twice, the last row wins.
+    Rows are tagged with the hash of the extractor parameters; appending with
+    new parameters makes the older rows of that extractor stale, and they are
+    ignored (and recomputed by extract_features) from then on.
+    """
+    def __init__(self, root='features/store/40X/'):
+        self.root = root
+
+    def __str__(self):
+        return self.root
+
+    def path(self, extractor, *parts):
+        return os.path.join(self.root, str(extractor), *parts)
+
+    def extractors(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if os.path.exists(os.path.join(self.root, name, 'index.csv')))
+
+    def params(self, extractor):
+        """Parameter hash the stored rows of the extractor are valid for."""
+        path = self.path(extractor, 'meta.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)['hash']
+
+    def index(self, extractor):
+        """Index of the extractor with one up-to-date row per fname, in insertion order."""
+        path = self.path(extractor, 'index.csv')
+        if not os.path.exists(path):
+            return pd.DataFrame(columns=index_columns)
+        index = pd.read_csv(path, dtype={'params': str})
+        if 'params' in index.columns and self.params(extractor) is not None:
+            index = index[index['params'] == self.params(extractor)]
+        return index.drop_duplicates('fname', keep='last').reset_index(drop=True)
+
+    def missing(self, extractor, fnames):
+        """The fnames without an up-to-date row for this extractor and its current parameters."""
+        if self.params(extractor) != params_hash(extractor):
+            return list(fnames)
+        done = set(self.index(extractor)['fname'])
+        return [fname for fname in fnames if fname not in done]
+
+    def shard(self, extractor, shard):
+        return np.load(self.path(extractor, f'shard_{shard:05d}.npy'), mmap_mode='r')
+
+    def num_features(self, extractor):
+        index = self.index(extractor)
+        if len(index) == 0:
+            return 0
+        return self.shard(extractor, int(index['shard'].iloc[0])).shape[1]
+
+    def next_shard(self, extractor):
+        shards = glob.glob(self.path(extractor, 'shard_*.npy'))
+        return max(int(os.path.basename(s)[6:11]) for s in shards) + 1 if shards else 0
+
+    def append(self, extractor, fnames, labels, values):
+        """Write a new shard for the rows and only then register them in the index."""
+        values = np.asarray(values, dtype=np.float32)
+        if values.ndim == 1:
+            values = values[None, :]
+        if len(values) == 0:
+            return
+
+        os.makedirs(self.path(extractor), exist_ok=True)
+        index_path = self.path(extractor, 'index.csv')
+        shard = self.next_shard(extractor)
+
+        # New parameters invalidate the rows computed with the old ones.
+        current = params_hash(extractor)
+        if self.params(extractor) != current:
+            with open(self.path(extractor, 'meta.json'), 'w') as f:
+                json.dump({'hash': current, 'params': extractor_params(extractor)}, f, indent=2, default=str)
+
+        np.save(self.path(extractor, f'shard_{shard:05d}.npy'), values)
+        records = pd.DataFrame({'fname': list(fnames), 'label': list(labels), 'shard': shard,
+                                'row': np.arange(len(values)), 'params': current})
+        records.to_csv(index_path, mode='a', index=False, header=not os.path.exists(index_path))
+
+    def compact(self, extractor):
+        """Rewrite the up-to-date rows into a single shard and delete the old shards."""
+        index = self.index(extractor)
+        values = self.read_rows(extractor, index)
+        old_shards = glob.glob(self.path(extractor, 'shard_*.npy'))
+
+        shard = self.next_shard(extractor)
+        np.save(self.path(extractor, f'shard_{shard:05d}.npy'), values)
+        index = index.assign(shard=shard, row=np.arange(len(index)))
+        index.to_csv(self.path(extractor, 'index.csv.tmp'), index=False)
+        os.replace(self.path(extractor, 'index.csv.tmp'), self.path(extractor, 'index.csv'))
+
+        for path in old_shards:
+            os.remove(path)
+
+    def read(self, extractor, fnames=None, columns=None, out=None):
+        """Random row access, returns the rows of the given fnames (all rows if None) in that order.
+
+        `columns` restricts the read to a subset of feature columns and `out`
+        can be a preallocated float32 array (or a view of one) to fill in place.
+        """
+        index = self.index(extractor)
+        if fnames is not None:
+            positions = pd.Series(np.arange(len(index)), index=index['fname'])
+            missing = set(fnames) - set(positions.index)
+            if missing:
+                raise KeyError(f"{len(missing)} fnames are not in the {extractor} store, e.g. {sorted(missing)[:3]}")
+            index = index.iloc[positions.loc[list(fnames)].to_numpy()]
+        return self.read_rows(extractor, index, columns, out)
+
+    def read_rows(self, extractor, index, columns=None, out=None):
+        """Gather the rows referenced by a slice of the index from the memory-mapped shards."""
+        if columns is None:
+            columns = slice(None)
+        if out is None:
+            width = len(np.arange(self.num_features(extractor))[columns])
+            out = np.empty((len(index), width), dtype=np.float32)
+
+        shards = index['shard'].to_numpy()
+        rows = index['row'].to_numpy()
+        for shard in np.unique(shards):
+            target = np.nonzero(shards == shard)[0]
+            data = self.shard(extractor, int(shard))
+            out[target] = data[rows[target]][:, columns]
+        return out
+
+    def load(self, extractor, fnames=None, columns=None):
+        """Return fnames, feature matrix and labels of an extractor."""
+        index = self.index(extractor)
+        if fnames is None:
+            fnames = index['fname'].to_numpy()
+        labels = index.set_index('fname').loc[list(fnames), 'label'].to_numpy()
+        return np.asarray(fnames), self.read(extractor, fnames, columns), labels
+
+    def iter_chunks(self, extractor, chunk_rows=1024, columns=None):
+        """Yield (fnames, X, y) chunks of an extractor without loading the full matrix."""
+        index = self.index(extractor)
+        for start in range(0, len(index), chunk_rows):
+            chunk = index.iloc[start:start + chunk_rows]
+            yield chunk['fname'].to_numpy(), self.read_rows(extractor, chunk, columns), chunk['label'].to_numpy()
+
+    def save_selection(self, extractor, name, indices, scores):
+        """Persist selected feature columns of an extractor, tagged with its current parameters."""
+        np.savez(self.path(extractor, f'selection_{name}.npz'), indices=indices, scores=scores,
+                 params=self.params(extractor) or '')
+
+    def selection(self, extractor, name):
+        """Column indices of a saved selection, None if the extractor has none under that name."""
+        path = self.path(extractor, f'selection_{name}.npz')
+        if not os.path.exists(path):
+            return None
+        selection = np.load(path)
+        if str(selection['params']) != (self.params(extractor) or ''):
+            raise ValueError(f"Selection {name} of {extractor} was computed for other extractor parameters.")
+        return selection['indices']
+
+    def import_csv_dir(self, extractor, folder, chunk_rows=1024):
+        """Convert a folder of per-image CSVs (features followed by the label) into the store."""
+        files = sorted(f for f in os.listdir(folder) if f.endswith('.csv'))
+        for start in tqdm(range(0, len(files), chunk_rows), desc=f'Importing {extractor}'):
+            rows = [np.loadtxt(os.path.join(folder, f), delimiter=',') for f in files[start:start + chunk_rows]]
+            rows = np.array(rows, dtype=np.float32)
+            self.append(extractor, [f[:-4] for f in files[start:start + chunk_rows]], rows[:, -1].astype(int), rows[:, :-1])
@@ -0,0 +1,82 @@
+import sys
+import json
+import time
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is then reported as NaN.
+    resource = None
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    if resource is None:
+        return np.nan
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+class ExtractorProfiler():
+    """Records wall time, CPU time, peak RSS growth and output dimensionality of extractor calls.
+
+    Batched calls are split evenly over the images they processed, so every
+    record is per extractor and per image.
+    """
+    def __init__(self):
+        self.records = []
+
+    def call(self, extractor, fn, *args, fnames=(None,), **kwargs):
+        rss = peak_rss_mb()
+        wall, cpu = time.perf_counter(), time.process_time()
+        values = fn(*args, **kwargs)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+        if isinstance(values, dict):
+            # Blocks of one call, e.g. MultiLayer.describe_blocks.
+            dims = sum(np.shape(block)[-1] for block in values.values())
+        else:
+            dims = np.shape(values)[-1] if len(fnames) > 1 else int(np.size(values))
+        for fname in fnames:
+            self.records.append({'extractor': str(extractor), 'fname': fname,
+                                 'wall_time': wall / len(fnames), 'cpu_time': cpu / len(fnames),
+                                 'peak_rss_delta_mb': (peak_rss_mb() - rss) / len(fnames), 'dims': dims})
+        return values
+
+    def describe(self, extractor, img, fname=None):
+        return self.call(extractor, extractor.describe, img, fnames=[fname])
+
+    def extend(self, records):
+        """Merge records collected by another profiler, e.g. in a worker process."""
+        self.records.extend(records)
+
+    def to_frame(self):
+        return pd.DataFrame(self.records, columns=['extractor', 'fname', 'wall_time', 'cpu_time', 'peak_rss_delta_mb', 'dims'])
+
+    def summary(self):
+        """Per-extractor totals and per-image percentiles, the most expensive extractor first."""
+        df = self.to_frame()
+        summary = df.groupby('extractor').agg(
+            images=('wall_time', 'size'),
+            wall_time=('wall_time', 'sum'),
+            cpu_time=('cpu_time', 'sum'),
+            wall_time_p50=('wall_time', 'median'),
+            wall_time_p95=('wall_time', lambda x: np.percentile(x, 95)),
+            peak_rss_delta_mb=('peak_rss_delta_mb', 'sum'),
+            dims=('dims', 'max'))
+        summary['time_share'] = summary['wall_time'] / max(summary['wall_time'].sum(), 1e-12)
+        return summary.sort_values('wall_time', ascending=False)
+
+    def save(self, path):
+        """Write the summary as JSON (with per-image records) or as CSV next to a records CSV."""
+        summary = self.summary()
+        if path.endswith('.json'):
+            with open(path, 'w') as f:
+                json.dump({'summary': summary.reset_index().to_dict(orient='records'),
+                           'records': self.to_frame().to_dict(orient='records')}, f, indent=2, default=str)
+        else:
+            summary.to_csv(path)
+            self.to_frame().to_csv(path[:-4] + '_records.csv' if path.endswith('.csv') else path + '_records.csv', index=False)
+        print(summary.to_string())
+        return summary
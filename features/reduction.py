@@ -0,0 +1,127 @@
+"""Dimensionality reduction of high-dimensional feature blocks (CNN, HOG).
+
+The projection is fitted in row chunks streamed from the feature store, so
+the full matrix is never loaded, and the reduced rows are written back as a
+new feature block named `<extractor>_<method><n_components>`, e.g.
+`alexnet_pca64`. That block is read like any other extractor, e.g. by
+classifiers.stack.read_feature_blocks for eval_classifiers.
+"""
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+from feature_store import FeatureStore, params_hash
+
+reduction_methods = ['pca', 'svd']
+
+class Reducer():
+    """Linear projection of one extractor's features onto `n_components` directions.
+
+    'pca' fits sklearn's IncrementalPCA chunk by chunk, 'svd' runs a
+    two-pass randomized SVD (Halko et al.) of the centered matrix: the first
+    pass sketches its range with a random projection, the second projects the
+    rows onto that range, and the small projected matrix is decomposed exactly.
+    """
+    def __init__(self, extractor, n_components=64, method='pca', oversamples=10, random_state=0):
+        if method not in reduction_methods:
+            raise ValueError(f"Unknown reduction method {method}, expected one of {reduction_methods}")
+        self.extractor = str(extractor)
+        self.n_components = n_components
+        self.method = method
+        self.oversamples = oversamples
+        self.random_state = random_state
+        # Reduced rows are tagged with the source parameters, new source features make them stale.
+        self.source = params_hash(extractor)
+        self.mean_ = None
+        self.components_ = None
+
+    def __str__(self):
+        return f'{self.extractor}_{self.method}{self.n_components}'
+
+    def fit(self, store, chunk_rows=1024):
+        self.source = store.params(self.extractor) or self.source
+        if self.method == 'pca':
+            self.fit_pca(store, max(chunk_rows, self.n_components))
+        else:
+            self.fit_svd(store, chunk_rows)
+        return self
+
+    def fit_pca(self, store, chunk_rows):
+        pca = IncrementalPCA(n_components=self.n_components)
+        pending = None
+        for _, X, _ in store.iter_chunks(self.extractor, chunk_rows):
+            # partial_fit needs at least n_components rows, a short last chunk joins the previous one.
+            if pending is not None and len(X) >= self.n_components:
+                pca.partial_fit(pending)
+                pending = X
+            else:
+                pending = X if pending is None else np.vstack([pending, X])
+        pca.partial_fit(pending)
+        self.mean_ = pca.mean_.astype(np.float32)
+        self.components_ = pca.components_.astype(np.float32)
+        self.explained_variance_ratio_ = pca.explained_variance_ratio_
+
+    def fit_svd(self, store, chunk_rows):
+        rng = np.random.default_rng(self.random_state)
+        width = self.n_components + self.oversamples
+        omega = rng.standard_normal((store.num_features(self.extractor), width))
+
+        # First pass: range sketch of X and the column means. Centering is linear,
+        # so (X - mean) @ omega is corrected afterwards instead of needing a mean pass.
+        sketch, total, squares, n = [], 0, 0, 0
+        for _, X, _ in store.iter_chunks(self.extractor, chunk_rows):
+            X = X.astype(np.float64)
+            sketch.append(X @ omega)
+            total = total + X.sum(axis=0)
+            squares += np.einsum('ij,ij->', X, X)
+            n += len(X)
+        mean = total / n
+        Q, _ = np.linalg.qr(np.vstack(sketch) - mean @ omega)
+
+        # Second pass: B = Q.T @ (X - mean), a (width x features) matrix.
+        B = -np.outer(Q.sum(axis=0), mean)
+        start = 0
+        for _, X, _ in store.iter_chunks(self.extractor, chunk_rows):
+            B += Q[start:start + len(X)].T @ X.astype(np.float64)
+            start += len(X)
+        _, S, Vt = np.linalg.svd(B, full_matrices=False)
+
+        self.mean_ = mean.astype(np.float32)
+        self.components_ = Vt[:self.n_components].astype(np.float32)
+        total_variance = squares - n * mean @ mean
+        self.explained_variance_ratio_ = S[:self.n_components] ** 2 / total_variance
+
+    def transform(self, X):
+        return (np.asarray(X, dtype=np.float32) - self.mean_) @ self.components_.T
+
+    def save(self, path):
+        np.savez(path, mean=self.mean_, components=self.components_,
+                 explained_variance_ratio=self.explained_variance_ratio_, source=self.source)
+
+    @classmethod
+    def load(cls, path, extractor, method='pca'):
+        projection = np.load(path)
+        reducer = cls(extractor, n_components=len(projection['components']), method=method)
+        reducer.mean_ = projection['mean']
+        reducer.components_ = projection['components']
+        reducer.explained_variance_ratio_ = projection['explained_variance_ratio']
+        reducer.source = str(projection['source'])
+        return reducer
+
+def reduce_features(store, extractor, n_components=64, method='pca', chunk_rows=1024):
+    """Fit a projection of an extractor, save it and write the reduced block to the store.
+
+    Returns the name of the new block.
+    """
+    reducer = Reducer(extractor, n_components, method).fit(store, chunk_rows)
+    reducer.save(store.path(extractor, f'{method}{n_components}.npz'))
+    for fnames, X, y in store.iter_chunks(extractor, chunk_rows):
+        store.append(reducer, fnames, y, reducer.transform(X))
+    print(f"{reducer}: {reducer.explained_variance_ratio_.sum():.3f} of the variance kept.")
+    return str(reducer)
+
+if __name__ == "__main__":
+    mf = '40X'
+    store = FeatureStore(f'features/store/{mf}/')
+
+    for extractor in ['alexnet', 'hog']:
+        if extractor in store.extractors():
+            reduce_features(store, extractor, n_components=64, method='pca')
@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import cv2
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Get the parent directory path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), "."))
+# Add the parent directory to the Python path
+sys.path.append(parent_dir)
+
+from feature_store import FeatureStore
+from profiling import ExtractorProfiler
+from tools import binary_paths
+
+# Extractors of the current worker process, set once by the pool initializer.
+worker_extractors = None
+
+def init_worker(extractors):
+    """Keep every worker single threaded, the pool already uses all cores."""
+    global worker_extractors
+    worker_extractors = extractors
+    cv2.setNumThreads(1)
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(1)
+
+def load_image(path, imsize=(456, 700)):
+    """Read and resize an image the same way tools.read_images does."""
+    return cv2.resize(cv2.imread(path), imsize)
+
+def describe_chunk(paths, needed, imsize=(456, 700)):
+    """Load each image of the chunk once and run every extractor it still needs.
+
+    Returns, per extractor, the positions in the chunk, their feature rows and the seconds spent,
+    together with the profiling records of the chunk.
+    """
+    profiler = ExtractorProfiler()
+    positions = [[] for _ in worker_extractors]
+    rows = [[] for _ in worker_extractors]
+    for i, path in enumerate(paths):
+        img = load_image(path, imsize)
+        fname = os.path.splitext(os.path.basename(path))[0]
+        for k, extractor in enumerate(worker_extractors):
+            if not needed[i, k]:
+                continue
+            rows[k].append(np.ravel(profiler.describe(extractor, img, fname)).astype(np.float32))
+            positions[k].append(i)
+
+    seconds = profiler.to_frame().groupby('extractor')['wall_time'].sum()
+    spent = [seconds.get(str(extractor), 0.0) for extractor in worker_extractors]
+    return list(zip(positions, rows, spent)), profiler.records
+
+def run_extraction(paths, labels, extractors, store, n_jobs=None, chunk_size=16, imsize=(456, 700), profiler=None):
+    """Extract all extractors over all images on a process pool and stream the rows to the store.
+
+    Images are split into chunks of `chunk_size`, every image is decoded once per
+    chunk and only the extractors without an up-to-date row in the store are run.
+    Once the last chunk of an extractor is stored, its shards are compacted into one.
+    Returns a per-extractor report of images, seconds and throughput, the
+    per-image measurements of the workers are merged into `profiler` if given.
+    """
+    fnames = np.array([os.path.splitext(os.path.basename(path))[0] for path in paths])
+    labels = np.asarray(labels)
+
+    needed = np.zeros((len(paths), len(extractors)), dtype=bool)
+    for k, extractor in enumerate(extractors):
+        needed[:, k] = np.isin(fnames, store.missing(extractor, fnames))
+    todo = np.nonzero(needed.any(axis=1))[0]
+    print(f"{len(paths) - len(todo)} images up to date, {len(todo)} to extract.")
+
+    images = np.zeros(len(extractors), dtype=int)
+    seconds = np.zeros(len(extractors))
+    start = time.perf_counter()
+    # Chunks left per extractor, the extractor is compacted when it reaches zero.
+    pending = np.zeros(len(extractors), dtype=int)
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_worker, initargs=(extractors,)) as executor:
+        futures = {}
+        for c in range(0, len(todo), chunk_size):
+            chunk = todo[c:c + chunk_size]
+            futures[executor.submit(describe_chunk, [paths[j] for j in chunk], needed[chunk], imsize)] = chunk
+            pending += needed[chunk].any(axis=0)
+
+        with tqdm(total=len(todo), desc='Extracting') as progress:
+            for future in as_completed(futures):
+                chunk = futures.pop(future)
+                results, records = future.result()
+                if profiler is not None:
+                    profiler.extend(records)
+                for k, (positions, rows, spent) in enumerate(results):
+                    if rows:
+                        rows_index = chunk[positions]
+                        store.append(extractors[k], fnames[rows_index], labels[rows_index], np.array(rows))
+                        pending[k] -= 1
+                        if pending[k] == 0:
+                            store.compact(extractors[k])
+                    images[k] += len(rows)
+                    seconds[k] += spent
+                progress.update(len(chunk))
+    wall = time.perf_counter() - start
+
+    report = pd.DataFrame({'extractor': [str(e) for e in extractors], 'images': images, 'seconds': seconds})
+    report['images_per_second'] = report['images'] / report['seconds'].where(report['seconds'] > 0)
+    report['time_share'] = report['seconds'] / max(report['seconds'].sum(), 1e-12)
+    print(report.to_string(index=False))
+    print(f"Wall time: {wall:.1f}s for {len(todo)} images.")
+    return report
+
+if __name__ == "__main__":
+    from extractors.lbp import LocalBinaryPatterns
+    from extractors.glcm import GLCM
+    from extractors.hog import HOG
+
+    mf = '40X'
+    benign, malign = binary_paths('../BreaKHis_v1/', mf)
+    if len(benign) + len(malign) == 0:
+        print("Please change data dir!!")
+        raise NotADirectoryError
+
+    extractors = [LocalBinaryPatterns(8, 1),
+                  GLCM(distances=[1], angles=[0, np.pi/4, np.pi/2, 3*np.pi/4], levels=256),
+                  HOG()]
+
+    report = run_extraction(benign + malign, [0] * len(benign) + [1] * len(malign), extractors,
+                            store=FeatureStore(f'features/store/{mf}/'))
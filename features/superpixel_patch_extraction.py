@@ -7,10 +7,12 @@ from skimage.util import img_as_float
 from cv2 import ximgproc
 import cv2
 import numpy as np
-from torchvision import transforms as T
-import torch
+import pandas as pd
 import time
 from tqdm import tqdm
+from scipy import ndimage
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 import os, sys
 
@@ -18,56 +20,94 @@ parent_dir = os.path.abspath(os.path.join(os.getcwd(), "."))
 # Add the parent directory to the Python path
 sys.path.append(parent_dir)
 
-from tools import BreaKHis
-
-
- 
-def divide_images_into_patches(images, targets_y, fnames, patch_size = (256, 256), method=cv2.ximgproc.SLICO, 
-                               mode='binary', mf = '40X'):
-    # fig, axs = plt.subplots(10, 5, figsize=(12, 6))
-    # axs = axs.ravel()
-    # count = 0
-
-    for ind, image in tqdm(enumerate(images)):
-        
-        image = cv2.GaussianBlur(image, (3, 3), 0)
-        # Convert image to Lab color space for better superpixel segmentation
-        image_lab = cv2.cvtColor(image, cv2.COLOR_RGB2Lab)
-        # Separate the stains from the IHC image
-        # hed = rgb2hed(image)
-        # null = np.zeros_like(hed[:, :, 0])
-        # ihc_h = hed2rgb(np.stack((hed[:, :, 0], null, null), axis=-1))
-        # ihc_e = hed2rgb(np.stack((null, hed[:, :, 1], null), axis=-1))
-        # ihc_d = hed2rgb(np.stack((null, null, hed[:, :, 2]), axis=-1))
-  
-        # instance and run SLIC
-        slic = cv2.ximgproc.createSuperpixelSLIC(image_lab, method, 100)
-        slic.iterate(50)
-
-        # replace original image pixels with superpixels means
-        labels = slic.getLabels()
-
-        unique_labels = np.unique(labels)
-        for lind, label in enumerate(unique_labels):
-            mask = labels == label
-            # Calculate the bounding box of the superpixel
-            x, y, w, h = cv2.boundingRect(mask.astype(np.uint8))
-            # Crop the corresponding region from the original image
-            patch = image[y:y+h, x:x+w, :]
-            patch = cv2.resize(patch, patch_size)
-            # if count < 50:
-            #     # print(np.nonzero(patch))
-            #     axs[count].imshow(patch)
-            #     axs[count].axis('off')
-            #     count += 1
-            # else:
-            #     plt.tight_layout()
-            #     plt.show()
-            key = 'benign' if targets_y[ind] == 0 else 'malignant'
-
-            path = f'features/all/{mode}/{mf}/imagelike/superpixels/patches/{key}/{fnames[ind]}_{lind}.png'
-            cv2.imwrite(path, patch)
-    return
+from tools import binary_paths
+
+index_columns = ['fname', 'label', 'patch', 'shard', 'row', 'x', 'y', 'w', 'h']
+
+def superpixel_boxes(labels):
+    """Bounding boxes (x, y, w, h) of every superpixel from a single pass over the label map."""
+    slices = ndimage.find_objects(labels + 1)
+    boxes = [(sx.start, sy.start, sx.stop - sx.start, sy.stop - sy.start)
+             for sy, sx in (s for s in slices if s is not None)]
+    return np.array(boxes, dtype=np.int32).reshape(-1, 4)
+
+def image_patches(path, patch_size=(256, 256), method=cv2.ximgproc.SLICO, region_size=100, iterations=50, imsize=(456, 700)):
+    """Read one image, segment it with SLIC and return its resized superpixel patches and boxes."""
+    image = cv2.resize(cv2.imread(path), imsize)
+
+    image = cv2.GaussianBlur(image, (3, 3), 0)
+    # Convert image to Lab color space for better superpixel segmentation
+    image_lab = cv2.cvtColor(image, cv2.COLOR_RGB2Lab)
+
+    # instance and run SLIC
+    slic = cv2.ximgproc.createSuperpixelSLIC(image_lab, method, region_size)
+    slic.iterate(iterations)
+
+    boxes = superpixel_boxes(slic.getLabels())
+    # Crop the corresponding regions from the original image
+    patches = np.stack([cv2.resize(image[y:y+h, x:x+w, :], patch_size) for x, y, w, h in boxes])
+    return patches, boxes
+
+def read_index(out_dir):
+    """Return the patch index of a (possibly partial) extraction run."""
+    path = os.path.join(out_dir, 'index.csv')
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=index_columns)
+    return pd.read_csv(path)
+
+def read_patches(out_dir, fname):
+    """Random access to the patches of one image through the shard index."""
+    index = read_index(out_dir)
+    rows = index[index['fname'] == fname]
+    patches = []
+    for shard, group in rows.groupby('shard', sort=False):
+        data = np.load(os.path.join(out_dir, f'shard_{shard:05d}.npy'), mmap_mode='r')
+        patches.append(data[group['row'].to_numpy()])
+    return np.concatenate(patches) if patches else np.empty((0,), dtype=np.uint8)
+
+def write_shard(out_dir, shard, patches, records):
+    """Save a packed shard first and only then append its rows to the index."""
+    np.save(os.path.join(out_dir, f'shard_{shard:05d}.npy'), np.concatenate(patches))
+    index_path = os.path.join(out_dir, 'index.csv')
+    pd.DataFrame(records, columns=index_columns).to_csv(index_path, mode='a', index=False,
+                                                        header=not os.path.exists(index_path))
+
+def divide_images_into_patches(paths, targets_y, out_dir, patch_size = (256, 256), method=cv2.ximgproc.SLICO,
+                               n_jobs=None, shard_size=2048, chunksize=4):
+    """Stream superpixel patches of the given images into packed shards.
+
+    Images are segmented on a process pool and their patches are packed into
+    `shard_XXXXX.npy` files next to an `index.csv`. Images already present in
+    the index are skipped, so an interrupted run resumes where it stopped.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    index = read_index(out_dir)
+    done = set(index['fname'])
+    shard = int(index['shard'].max()) + 1 if len(index) else 0
+
+    fnames = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    todo = [i for i, fname in enumerate(fnames) if fname not in done]
+    print(f"{len(done)} images already extracted, {len(todo)} to go.")
+
+    worker = partial(image_patches, patch_size=patch_size, method=method)
+    buffer, records = [], []
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        results = executor.map(worker, [paths[i] for i in todo], chunksize=chunksize)
+        for ind, (patches, boxes) in tqdm(zip(todo, results), total=len(todo)):
+            offset = sum(len(p) for p in buffer)
+            buffer.append(patches)
+            for lind, (x, y, w, h) in enumerate(boxes):
+                records.append((fnames[ind], targets_y[ind], lind, shard, offset + lind, x, y, w, h))
+
+            # Shards are only cut at image boundaries so an image never spans two shards.
+            if offset + len(patches) >= shard_size:
+                write_shard(out_dir, shard, buffer, records)
+                shard += 1
+                buffer, records = [], []
+
+    if buffer:
+        write_shard(out_dir, shard, buffer, records)
+    return read_index(out_dir)
 
 
 if __name__ == '__main__':
@@ -98,21 +138,14 @@ if __name__ == '__main__':
     # plt.imshow(cv_slico.getLabelContourMask())
     # plt.show()
     mf = '40X'
+    mode = 'binary'
+
+    benign, malign = binary_paths('../BreaKHis_v1/', mf)
+    paths = benign + malign
+    targets_y = [0] * len(benign) + [1] * len(malign)
+    print("Number of images", len(paths))
 
-    print("Hello User! Dataset is loading....")
     startTime = time.time()
-    myDataset = BreaKHis(
-                    transform = T.Compose([
-                    T.ToPILImage(),  # Convert numpy.ndarray to PIL Image
-                    T.Resize(256),
-                    T.CenterCrop(224),
-                    T.ToTensor(),
-                ]),
-                    mf = mf, 
-                    mode = 'binary'
-                    )
-    
+    index = divide_images_into_patches(paths, targets_y, f'features/all/{mode}/{mf}/imagelike/superpixels/patches/')
     print("Elapsed time in min: ", (time.time() - startTime)/60)
-    print("Size of dataset", len(myDataset))
-
-    divide_images_into_patches(myDataset.images, myDataset.targets, myDataset.fnames)
+    print("Number of patches", len(index))
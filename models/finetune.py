@@ -10,9 +10,9 @@ import time
 from models.fpcn import FPCN
 from models.utilities.losses import FocalLoss
 from utilities.phases import *
+from utilities.superpixels import build_superpixel_cache, SuperpixelPatchDataset
 import os, sys
 import warnings 
-from sklearn.model_selection import StratifiedShuffleSplit
 from torch import random
 
 parent_dir = os.path.abspath(os.path.join(os.getcwd(), "."))
@@ -20,6 +20,7 @@ parent_dir = os.path.abspath(os.path.join(os.getcwd(), "."))
 sys.path.append(parent_dir)
 
 from tools import BreaKHis, plot, read_means_and_stds
+from splits import train_test_indices
 
 def assign_class_weights(labels, normalize=True):
     # Compute the class frequencies
@@ -38,17 +39,16 @@ def assign_class_weights(labels, normalize=True):
 
     return weights
 
-def set_loaders(myDataset, seed=42, test_split=0.3, bs=16):
-    
+def set_loaders(myDataset, test_split=0.3, bs=16, patch_cache=None, mf='40X'):
+    # The split is by patient, shared with the feature classifiers of the same magnification (splits.py),
+    # which also fixes its seed.
+    fnames, class_labels = myDataset.fnames, myDataset.targets
 
-    # Assuming you have your dataset object named 'myDataset' and the desired test split ratio
-    # Get the class labels and total number of samples from your dataset
-    class_labels = myDataset.targets
-    total_samples = len(myDataset)
+    # Items carry their precomputed superpixel boxes for patch training.
+    if patch_cache is not None:
+        myDataset = SuperpixelPatchDataset(myDataset, patch_cache)
 
-    # Perform stratified shuffle split
-    splitter = StratifiedShuffleSplit(n_splits=1, test_size=test_split, random_state=seed)
-    train_indices, test_indices = next(splitter.split(range(total_samples), class_labels))
+    train_indices, test_indices = train_test_indices(fnames, class_labels, mf, test_split)
 
     training_data = Subset(myDataset, train_indices)
     test_data = Subset(myDataset, test_indices)
@@ -137,12 +137,17 @@ if __name__ == '__main__':
     class_weights = torch.tensor([class_weight_0, class_weight_1], device=device)
     
     print(_, counts)
+
+    # Superpixels are computed once per image and reused by every epoch.
+    patch = False
+    patch_cache = build_superpixel_cache(myDataset, path=f'features/all/binary/{mf}/superpixel_boxes.npz') if patch else None
     
     train_loader, test_loader = set_loaders(
     myDataset,
-    seed=42, 
     test_split=0.3, 
-    bs=32)
+    bs=32,
+    patch_cache=patch_cache,
+    mf=mf)
     
     del myDataset
 
@@ -182,7 +187,7 @@ if __name__ == '__main__':
                         weight_decay=0.001)
 
         # Annotation follows: magnification factor; augmentation method; pretrained, model type; optimizer type, learning rate; loss, parameters; batch size, sampling strategy; # of epochs
-        eval(model, test_loader, train_loader, optimizer, criterion, device, mean_per_ch, std_per_ch, patch=False ,num_epochs=100, mf=mf, model_name=f"400X_on-air-aug_std_weightrandom_pre-{model_name}_sgde-2e-4_bcew_32bs-strf_100ep")
+        eval(model, test_loader, train_loader, optimizer, criterion, device, mean_per_ch, std_per_ch, patch=patch ,num_epochs=100, mf=mf, model_name=f"400X_on-air-aug_std_weightrandom_pre-{model_name}_sgde-2e-4_bcew_32bs-strf_100ep")
 
 # binary
 
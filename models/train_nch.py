@@ -5,7 +5,7 @@ from torch import optim
 from torchvision import transforms as T
 from torch.autograd import Variable
 from torch.optim import lr_scheduler
-from torch.utils.data import WeightedRandomSampler, random_split, RandomSampler
+from torch.utils.data import WeightedRandomSampler, random_split, RandomSampler, Subset
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import time
@@ -20,12 +20,14 @@ parent_dir = os.path.abspath(os.path.join(os.getcwd(), "."))
 sys.path.append(parent_dir)
 
 from tools import BreaKHis, plot
+from splits import train_test_indices
 
 
-def set_loaders(myDataset, seed=42, test_split=0.3, bs=16):
-    generator = torch.Generator().manual_seed(seed)
-
-    training_data, test_data = random_split(myDataset, [1-test_split, test_split], generator=generator)
+def set_loaders(myDataset, test_split=0.3, bs=16, mf='40X'):
+    # The split is by patient, so the augmented copies of an image stay on its side (splits.py),
+    # which also fixes its seed.
+    train_indices, test_indices = train_test_indices(myDataset.fnames, myDataset.targets, mf, test_split)
+    training_data, test_data = Subset(myDataset, train_indices), Subset(myDataset, test_indices)
     print("Dataset is split for training, validation and test phases --> \n",
             "training:", len(training_data), "\n",
             "test:", (len(test_data)), "\n"
@@ -147,9 +149,9 @@ if __name__ == '__main__':
     print(np.unique(myDataset.targets, return_counts=True))
     train_loader, test_loader = set_loaders(
     myDataset,
-    seed=42, 
     test_split=0.3, 
-    bs=16)
+    bs=16,
+    mf=mf)
 
     del myDataset
 
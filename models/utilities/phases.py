@@ -8,11 +8,16 @@ import datetime
 import numpy as np
 import torch.nn.functional as F
 from . import visualize
+from .superpixels import sample_superpixel_patches
 from torchvision import transforms as T
-import cv2
-import numpy as np
-from skimage.color import rgb2hed, hed2rgb
-from torch.utils.data import WeightedRandomSampler
+from torch.utils.data import Subset
+import os, sys
+
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), "."))
+# Add the parent directory to the Python path
+sys.path.append(parent_dir)
+
+from classifiers.metrics import recognition_rates
 
 p = 0.8
 r = 0.3
@@ -71,98 +76,6 @@ def apply_on_air_augmentation(X, y, n, r=0.5,
 
     return selected_X_aug, selected_y
 
-import cv2
-import numpy as np
-
- # cv::ximgproc::SLIC = 100,
- # cv::ximgproc::SLICO = 101,
- # cv::ximgproc::MSLIC = 102 
-def divide_images_into_patches(images, targets_y, patch_size, device, mean_per_ch, std_per_ch,
-                    method=cv2.ximgproc.SLIC, s=50):
-    
-    transform = T.Compose([
-                    T.ToPILImage(),  # Convert numpy.ndarray to PIL Image
-                    T.Resize(256),
-                    T.CenterCrop(224),
-                    T.ToTensor(),
-                    T.Normalize(mean=mean_per_ch[:-1], std=std_per_ch[:-1])
-                ])
-    # Compute class weights
-    class_counts = torch.bincount(targets_y.long())
-    class_weights = 1.0 / class_counts.float()
-
-    # Create weighted sampler
-    weights = class_weights[targets_y.long()]
-    sampler = WeightedRandomSampler(weights, int(len(weights)/2), replacement=True)
-
-    # Apply sampler to indices
-    sampled_indices = list(sampler)
-    selected_images = images[sampled_indices]
-    selected_targets_y = targets_y[sampled_indices]
-
-    # Generate patches based on superpixels
-    patches = []
-    targets = []
-
-    for ind, image in enumerate(selected_images):
-        image = image.cpu().numpy()
-        image = np.transpose(image, axes=(1, 2, 0))
-
-        image = cv2.GaussianBlur(image, (3, 3), 0)
-        # Convert image to Lab color space for better superpixel segmentation
-        image_lab = cv2.cvtColor(image, cv2.COLOR_RGB2Lab)
-        # Separate the stains from the IHC image
-        # hed = rgb2hed(image)
-        # null = np.zeros_like(hed[:, :, 0])
-        # ihc_h = hed2rgb(np.stack((hed[:, :, 0], null, null), axis=-1))
-        # ihc_e = hed2rgb(np.stack((null, hed[:, :, 1], null), axis=-1))
-        # ihc_d = hed2rgb(np.stack((null, null, hed[:, :, 2]), axis=-1))
-  
-        # instance and run SLIC
-        slic = cv2.ximgproc.createSuperpixelSLIC(image_lab, algorithm = method, region_size = s, ruler=20.0)
-        slic.iterate(100)
-
-
-        # Get the contour mask
-        # contour_mask = slic.getLabelContourMask()
-
-        # # Create a copy of the image to overlay the contour
-        # output = image.copy()
-
-        # # Apply the contour mask as an overlay on the image
-        # output[contour_mask > 0] = [0, 0, 255]  # Red color for the contour pixels
-        
-        # plt.imshow(cv2.cvtColor(output, cv2.COLOR_BGR2RGB))
-        # plt.axis('off')
-        # plt.tight_layout()
-        # plt.show()
-
-        # Get the labels and number of superpixels
-        labels = slic.getLabels()
-        unique_labels = np.unique(labels)
-        # Randomly select half of the labels
-        np.random.shuffle(unique_labels)
-        selected_labels = unique_labels[:len(unique_labels) // 6]
-
-        for label in selected_labels:
-            mask = labels == label
-            # Calculate the bounding box of the superpixel
-            x, y, w, h = cv2.boundingRect(mask.astype(np.uint8))
-            # Crop the corresponding region from the original image
-            patch = image[y:y+h, x:x+w, :]
-            patch = cv2.resize(patch, patch_size)
-            transformed_patch = transform(torch.Tensor(np.transpose(patch, axes=(-1, 0, 1)))).to(device)
-
-            patches.append(transformed_patch)    
-            targets.append(selected_targets_y[ind])
-
-    patches = torch.stack(patches)
-    targets = torch.Tensor(targets)
-
-
-    return patches, targets
-
-
 def train(model, train_loader, optimizer, criterion, eval_metrics, device, 
           mean_per_ch, std_per_ch,
           aug=True, 
@@ -178,7 +91,7 @@ def train(model, train_loader, optimizer, criterion, eval_metrics, device,
 
     prev_y = None
     prev_X = None
-    for batch, (X, y) in enumerate(train_loader):
+    for batch, (X, y, *patch_info) in enumerate(train_loader):
 
         if prev_y and prev_X:
             X = torch.concat((X, prev_X))
@@ -198,9 +111,9 @@ def train(model, train_loader, optimizer, criterion, eval_metrics, device,
         # print("Before", np.unique(y.cpu().detach().numpy(), return_counts=True))
 
         if patch:
-            patch_X, patch_y = divide_images_into_patches(X, y, (226, 226), device, mean_per_ch, std_per_ch)
-            patch_X = torch.Tensor(patch_X).to(device)
-            patch_y = torch.Tensor(patch_y).to(device)
+            if not patch_info:
+                raise ValueError("patch=True needs loaders over a SuperpixelPatchDataset, see build_superpixel_cache.")
+            patch_X, patch_y = sample_superpixel_patches(X, y, *patch_info, (224, 224), mean_per_ch, std_per_ch)
 
             # Shuffle the stacked data and labels
             indices = torch.randperm(patch_X.size(0))
@@ -278,6 +191,17 @@ def train(model, train_loader, optimizer, criterion, eval_metrics, device,
     print(epoch_scores)
     return epoch_scores
 
+def dataset_fnames(dataset):
+    """Image names of the items of a dataset, through Subset and wrapper datasets, None if it has none."""
+    if isinstance(dataset, Subset):
+        fnames = dataset_fnames(dataset.dataset)
+        return None if fnames is None else fnames[dataset.indices]
+    if hasattr(dataset, 'fnames'):
+        return np.asarray(dataset.fnames)
+    if hasattr(dataset, 'dataset'):
+        return dataset_fnames(dataset.dataset)
+    return None
+
 def test(model, test_loader, criterion, eval_metrics, device, mean_per_ch, std_per_ch, 
          epoch=-1, 
          patch=False):
@@ -285,6 +209,11 @@ def test(model, test_loader, criterion, eval_metrics, device, mean_per_ch, std_p
     average_loss = 0
     metric_values = {metric_name: [] for metric_name in eval_metrics.keys()}
 
+    # Predictions by item position, for the image and patient recognition rates of unshuffled whole-image loaders.
+    fnames = None if patch else dataset_fnames(test_loader.dataset)
+    positions, labels, predictions = [], [], []
+    offset = 0
+
     # model.to(device)
     if device != 'cpu':
         model = nn.DataParallel(model)
@@ -292,7 +221,7 @@ def test(model, test_loader, criterion, eval_metrics, device, mean_per_ch, std_p
     prev_y = None
     prev_X = None
     
-    for batch, (X, y) in enumerate(test_loader):
+    for batch, (X, y, *patch_info) in enumerate(test_loader):
 
         if prev_y and prev_X:
             X = torch.concat((X, prev_X))
@@ -300,6 +229,8 @@ def test(model, test_loader, criterion, eval_metrics, device, mean_per_ch, std_p
 
         X = X.to(device)
         y = y.to(device)
+        batch_positions = np.arange(offset, offset + len(y))
+        offset += len(y)
 
         if len(y) == 1: 
             print("Only one element! End of batches.")
@@ -308,10 +239,9 @@ def test(model, test_loader, criterion, eval_metrics, device, mean_per_ch, std_p
             continue
 
         if patch:
-            # print("??????")
-            patch_X, patch_y = divide_images_into_patches(X, y, (226, 226), device, mean_per_ch, std_per_ch)
-            patch_X = torch.Tensor(patch_X).to(device)
-            patch_y = torch.Tensor(patch_y).to(device)
+            if not patch_info:
+                raise ValueError("patch=True needs loaders over a SuperpixelPatchDataset, see build_superpixel_cache.")
+            patch_X, patch_y = sample_superpixel_patches(X, y, *patch_info, (224, 224), mean_per_ch, std_per_ch)
             
             # Shuffle the stacked data and labels
             indices = torch.randperm(patch_X.size(0))
@@ -349,6 +279,11 @@ def test(model, test_loader, criterion, eval_metrics, device, mean_per_ch, std_p
                     metric_val = metric(yhat, y_vectors)
 
                 metric_values[metric_name].append(metric_val.item())
+
+            if fnames is not None:
+                positions.append(batch_positions)
+                labels.append(y.cpu().numpy())
+                predictions.append(yhat_labs.cpu().numpy())
         
     average_loss /= len(test_loader)
     epoch_scores = {
@@ -357,6 +292,11 @@ def test(model, test_loader, criterion, eval_metrics, device, mean_per_ch, std_p
         **{metric_name: sum(metric_values[metric_name]) / len(metric_values[metric_name]) for metric_name in eval_metrics}
     }
 
+    if positions:
+        image_rate, patient_rate = recognition_rates(fnames[np.concatenate(positions)], np.concatenate(labels), np.concatenate(predictions))
+        epoch_scores['image_recognition_rate'] = image_rate
+        epoch_scores['patient_recognition_rate'] = patient_rate
+
     print(epoch_scores)
     return epoch_scores
 
@@ -384,7 +324,11 @@ def eval(model, test_loader, train_loader, optimizer, criterion, device, mean_pe
     'specificity': 'Specificity'
     }
 
-    # TODO:  Add pattern recognition rate.
+    # Only the test phase reports them, its loader keeps the item order.
+    test_titles = {
+    'image_recognition_rate': 'Image Recognition Rate',
+    'patient_recognition_rate': 'Patient Recognition Rate'
+    }
 
     for t in tqdm(range(num_epochs), desc='Training on Breast Histopathology Dataset', unit='epoch'):
         print(f"Epoch {t+1}\n-------------------------------")
@@ -422,4 +366,7 @@ def eval(model, test_loader, train_loader, optimizer, criterion, device, mean_pe
                                 path=f'models/results/{mf}/figs/{model_name}_{date_string}_{metric}.png',
                                 metric=metric,
                                 title=title)
+    for metric, title in test_titles.items():
+        if metric in test_df.columns:
+            print(f"{title}: {test_df[metric].iloc[-1]:.4f}")
     print(model_name, "Done!")
@@ -0,0 +1,122 @@
+import os
+import cv2
+import numpy as np
+import torch
+from scipy import ndimage
+from torch.utils.data import Dataset
+from torchvision.ops import roi_align
+from tqdm import tqdm
+
+ # cv::ximgproc::SLIC = 100,
+ # cv::ximgproc::SLICO = 101,
+ # cv::ximgproc::MSLIC = 102
+def superpixel_boxes(image, method=cv2.ximgproc.SLIC, s=50, ruler=20.0, iterations=100):
+    """Run SLIC once on a (C, H, W) image tensor and return the (x1, y1, x2, y2) box of every superpixel."""
+    image = np.ascontiguousarray(np.transpose(image[:3].numpy(), axes=(1, 2, 0)), dtype=np.float32)
+
+    image = cv2.GaussianBlur(image, (3, 3), 0)
+    # Convert image to Lab color space for better superpixel segmentation
+    image_lab = cv2.cvtColor(image, cv2.COLOR_RGB2Lab)
+
+    # instance and run SLIC
+    slic = cv2.ximgproc.createSuperpixelSLIC(image_lab, algorithm = method, region_size = s, ruler=ruler)
+    slic.iterate(iterations)
+
+    # One pass over the label map gives the bounding boxes of all superpixels.
+    slices = ndimage.find_objects(slic.getLabels() + 1)
+    boxes = [(sx.start, sy.start, sx.stop, sy.stop) for sy, sx in (s for s in slices if s is not None)]
+    return np.array(boxes, dtype=np.float32).reshape(-1, 4)
+
+def reorder_cache(cache, fnames):
+    """Boxes and offsets of a cache rearranged to the order of `fnames`, None if it does not hold all of them."""
+    # Repeated names (augmented copies) share the boxes of their first occurrence.
+    position = {fname: i for i, fname in reversed(list(enumerate(cache['fnames'])))}
+    if not all(fname in position for fname in fnames):
+        return None
+    rows = np.array([position[fname] for fname in fnames], dtype=int)
+    starts, ends = cache['offsets'][rows], cache['offsets'][rows + 1]
+    boxes = [cache['boxes'][start:end] for start, end in zip(starts, ends)]
+    offsets = np.concatenate([[0], np.cumsum(ends - starts)])
+    return {'boxes': np.concatenate(boxes).reshape(-1, 4), 'offsets': offsets}
+
+def build_superpixel_cache(dataset, path=None, **kwargs):
+    """Compute superpixel boxes for every image of the dataset once, or load them from `path`.
+
+    The cache is keyed by the image names of the dataset (`dataset.fnames`), so a
+    reshuffled dataset gets its boxes back in its own order; a cache that does
+    not cover the dataset's images is rebuilt. Datasets without fnames are cached by position.
+    """
+    fnames = getattr(dataset, 'fnames', None)
+    fnames = None if fnames is None else np.asarray(fnames).astype(str)
+    if path and os.path.exists(path):
+        saved = np.load(path)
+        if fnames is not None and 'fnames' in saved.files:
+            cache = reorder_cache(saved, fnames)
+            if cache is not None:
+                return cache
+        elif fnames is None and len(saved['offsets']) == len(dataset) + 1:
+            return {'boxes': saved['boxes'], 'offsets': saved['offsets']}
+        print(f"{path} does not match the dataset, computing the superpixels again.")
+
+    boxes = [superpixel_boxes(dataset[i][0], **kwargs) for i in tqdm(range(len(dataset)), desc='Superpixels')]
+    offsets = np.concatenate([[0], np.cumsum([len(b) for b in boxes])])
+    cache = {'boxes': np.concatenate(boxes), 'offsets': offsets}
+
+    if path:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez(path, **cache, **({} if fnames is None else {'fnames': fnames}))
+    return cache
+
+class SuperpixelPatchDataset(Dataset):
+    """Wraps a dataset so every item also carries its cached superpixel boxes.
+
+    Boxes are padded to the largest number of superpixels in the cache so they
+    can be collated, the second extra value is the number of valid boxes.
+    """
+    def __init__(self, dataset, cache):
+        super(SuperpixelPatchDataset, self).__init__()
+        self.dataset = dataset
+        self.targets = dataset.targets
+        self.boxes = torch.from_numpy(cache['boxes'])
+        self.offsets = cache['offsets']
+        self.max_boxes = int(np.max(np.diff(self.offsets)))
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        img, target = self.dataset[index]
+        start, end = self.offsets[index], self.offsets[index + 1]
+
+        boxes = torch.zeros((self.max_boxes, 4))
+        boxes[:end - start] = self.boxes[start:end]
+        return img, target, boxes, end - start
+
+def sample_superpixel_patches(images, targets_y, boxes, counts, patch_size, mean_per_ch, std_per_ch, fraction=1/6):
+    """Sample class balanced superpixel patches from a batch with one batched roi_align call."""
+    device = images.device
+    boxes = boxes.to(device)
+    counts = counts.to(device)
+
+    # Class balanced sampling of half of the images, with replacement.
+    class_counts = torch.bincount(targets_y.long())
+    weights = (1.0 / class_counts.float())[targets_y.long()]
+    sampled = torch.multinomial(weights, max(int(len(weights)/2), 1), replacement=True)
+
+    # Randomly keep a fraction of the valid superpixels of every sampled image.
+    counts = counts[sampled]
+    scores = torch.rand(len(sampled), boxes.shape[1], device=device)
+    scores[torch.arange(boxes.shape[1], device=device)[None, :] >= counts[:, None]] = -1
+    ranks = torch.argsort(torch.argsort(scores, dim=1, descending=True), dim=1)
+    keep = ranks < torch.clamp((counts * fraction).long(), min=1)[:, None]
+
+    rows, cols = torch.nonzero(keep, as_tuple=True)
+    rois = torch.cat([sampled[rows, None].float(), boxes[sampled[rows], cols]], dim=1)
+
+    patches = roi_align(images.float(), rois, output_size=patch_size, aligned=True)
+
+    mean = torch.as_tensor(mean_per_ch[:-1], dtype=patches.dtype, device=device)[None, :, None, None]
+    std = torch.as_tensor(std_per_ch[:-1], dtype=patches.dtype, device=device)[None, :, None, None]
+    patches = (patches - mean) / std
+
+    return patches, targets_y[sampled[rows]].float()
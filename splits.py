@@ -0,0 +1,92 @@
+"""Patient-grouped, stratified splits of BreaKHis, made once per magnification.
+
+Images of one patient never end up on both sides of a split. The fold of
+every image is saved in splits/<mf>.csv (fname, label, patient, fold and the
+random_state it was shuffled with; the directory is not tracked by git), and
+every training path reads its folds from there, so all experiments on a
+magnification are evaluated on the same patients:
+
+    eval_classifiers, fusion, search, stacking     PatientKFold
+    finetune / train_nch set_loaders, split_data    train_test_indices
+"""
+import os
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import StratifiedGroupKFold
+
+from tools import patient_ids
+
+splits_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'splits')
+
+def splits_path(mf, root=splits_dir):
+    return os.path.join(root, f'{mf}.csv')
+
+def make_splits(fnames, labels, mf, n_splits=10, root=splits_dir, random_state=0):
+    """Assign every image to a fold with stratified, patient-grouped K-fold and save the table."""
+    table = pd.DataFrame({'fname': np.asarray(fnames), 'label': np.asarray(labels)}).drop_duplicates('fname')
+    table['patient'] = patient_ids(table['fname'])
+    table['fold'] = -1
+    table['random_state'] = random_state
+    cv = StratifiedGroupKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    for k, (_, test) in enumerate(cv.split(table, table['label'], table['patient'])):
+        table.iloc[test, table.columns.get_loc('fold')] = k
+
+    os.makedirs(root, exist_ok=True)
+    table.to_csv(splits_path(mf, root), index=False)
+    return table
+
+def load_splits(fnames, labels, mf, n_splits=10, root=splits_dir, random_state=0):
+    """Fold of every fname, from the saved splits of the magnification, made on first use.
+
+    Images missing from the table (e.g. augmented copies under a new name)
+    follow their patient; a new patient, another number of folds or another
+    `random_state` than the saved splits were made with raise a ValueError
+    rather than silently changing or ignoring the folds.
+    """
+    path = splits_path(mf, root)
+    if not os.path.exists(path):
+        table = make_splits(fnames, labels, mf, n_splits, root, random_state)
+    else:
+        table = pd.read_csv(path)
+    if table['fold'].nunique() != n_splits:
+        raise ValueError(f"{path} has {table['fold'].nunique()} folds, not {n_splits}.")
+    if 'random_state' in table.columns and table['random_state'].iloc[0] != random_state:
+        raise ValueError(f"{path} was made with random_state={table['random_state'].iloc[0]}, not {random_state}; "
+                         f"remove it to split again.")
+
+    folds = pd.Series(table['fold'].to_numpy(), index=table['fname']).reindex(np.asarray(fnames))
+    if folds.isna().any():
+        by_patient = table.groupby('patient')['fold'].first()
+        missing = folds.isna().to_numpy()
+        patients = pd.Series(patient_ids(np.asarray(fnames)[missing]))
+        if not patients.isin(by_patient.index).all():
+            raise ValueError(f"{path} does not cover patient {patients[~patients.isin(by_patient.index)].iloc[0]}, "
+                             f"remove it to split again.")
+        folds[missing] = by_patient.loc[patients].to_numpy()
+    return folds.to_numpy().astype(int)
+
+def train_test_indices(fnames, labels, mf, test_split=0.3, n_splits=10, root=splits_dir, random_state=0):
+    """Hold-out split made of whole folds: the first round(test_split * n_splits) folds are the test set."""
+    folds = load_splits(fnames, labels, mf, n_splits, root, random_state)
+    test = folds < max(1, round(test_split * n_splits))
+    return np.nonzero(~test)[0], np.nonzero(test)[0]
+
+class PatientKFold():
+    """Cross-validation splitter over the saved patient-grouped folds, for the rows of `fnames`.
+
+    Can be passed wherever a scikit-learn splitter is expected.
+    """
+    def __init__(self, fnames, mf, n_splits=10, root=splits_dir, random_state=0):
+        self.fnames = np.asarray(fnames)
+        self.mf = mf
+        self.n_splits = n_splits
+        self.root = root
+        self.random_state = random_state
+
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return self.n_splits
+
+    def split(self, X, y=None, groups=None):
+        folds = load_splits(self.fnames, y, self.mf, self.n_splits, self.root, self.random_state)
+        for k in range(self.n_splits):
+            yield np.nonzero(folds != k)[0], np.nonzero(folds == k)[0]
@@ -44,6 +44,17 @@ def plot(imgs, orig_imgs, row_title='Transformed Image', **imshow_kwargs):
 def alter_name(fname):
     fname = fname.split('\\')[-1]
     return fname.split('.')[0]
+
+def patient_ids(fnames):
+    """Patient of every BreaKHis image name, e.g. SOB_B_A-14-22549AB-40-003 -> 14-22549AB."""
+    names = pd.Series(np.asarray(fnames, dtype=str)).str.replace(r'^.*[\\/]', '', regex=True)
+    ids = names.str.extract(r'^SOB_[BM]_[A-Z]+-(\d+-[0-9A-Za-z]+)-\d+-\d+')[0]
+    if ids.isna().any():
+        raise ValueError(f"Not a BreaKHis image name: {names[ids.isna()].iloc[0]}")
+    return ids.to_numpy()
+
+def patient_id(fname):
+    return patient_ids([fname])[0]
     
 def read_images(path_arr, binary_label=None, multiclass_label = None, imsize=None):
     # Initialize variables